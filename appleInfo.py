@@ -4,6 +4,8 @@ import datetime
 import configparser
 from colorama import Fore, Style, init
 from snipe import Snipe
+from appledb import get_appledb
+from imagecache import get_image_cache
 
 # Initialize colorama for colored terminal output
 init()
@@ -24,10 +26,14 @@ ios_fieldset_id = config['snipe-it']['ios_fieldset_id']
 tvos_fieldset_id = config['snipe-it']['tvos_fieldset_id']
 snipe_rate_limit = int(config['snipe-it']['rate_limit'])
 apple_image_check = config['snipe-it'].getboolean('apple_image_check')
+cache_dir = config.get('cache', 'cache_dir', fallback='cache')
+appledb_ttl = config.getfloat('cache', 'appledb_ttl_hours', fallback=24) * 3600
+image_cache_bytes = int(config.getfloat('cache', 'image_cache_mb', fallback=50) * 1024 * 1024)
 
 # Initialize Snipe API
 snipe = Snipe(apiKey, snipe_url, apple_manufacturer_id, macos_category_id, ios_category_id, tvos_category_id,
-              snipe_rate_limit, macos_fieldset_id, ios_fieldset_id, tvos_fieldset_id, apple_image_check)
+              snipe_rate_limit, macos_fieldset_id, ios_fieldset_id, tvos_fieldset_id, apple_image_check,
+              appledb=get_appledb(cache_dir, appledb_ttl), image_cache=get_image_cache(cache_dir, image_cache_bytes))
 
 # Fetch all models
 try:
@@ -0,0 +1,147 @@
+"""
+AppleDB device catalog cache.
+Keeps a copy of https://api.appledb.dev/device/main.json on disk, revalidates it with
+ETag/If-Modified-Since once the TTL expires, and indexes it for O(1) model lookups.
+"""
+import json
+import threading
+import time
+from pathlib import Path
+
+import requests
+
+from cache import atomic_write, read_json, write_json
+from logger_config import get_logger
+
+
+CATALOG_URL = "https://api.appledb.dev/device/main.json"
+DEFAULT_COLOR = "Silver"
+
+# Seconds to wait before retrying a failed download when no cached copy exists
+COLD_RETRY_SECONDS = 300
+
+
+class AppleDB:
+    def __init__(self, cache_dir="cache", ttl=86400, url=CATALOG_URL, timeout=(10, 60)):
+        self.cache_dir = Path(cache_dir) / "appledb"
+        self.ttl = ttl
+        self.url = url
+        self.timeout = timeout
+        self.session = requests.Session()
+        self._index = None
+        self._checked_at = 0
+        self._lock = threading.Lock()
+
+    @property
+    def catalog_path(self):
+        return self.cache_dir / "main.json"
+
+    @property
+    def meta_path(self):
+        return self.cache_dir / "main.meta.json"
+
+    def lookup(self, model_number):
+        """
+        Find the AppleDB device for a model identifier or deviceMap entry.
+
+        Args:
+            model_number: Model identifier as reported by Mosyle, e.g. "MacBookPro18,3"
+
+        Returns:
+            tuple: (device_key, default_color), or None if AppleDB has no such device
+        """
+        return self.index().get(model_number)
+
+    def index(self):
+        """Return the identifier index, loading or revalidating the catalog if the TTL expired."""
+        with self._lock:
+            now = time.time()
+            if self._index is None or now - self._checked_at >= self.ttl:
+                self._refresh(now)
+            return self._index
+
+    def _refresh(self, now):
+        logger = get_logger()
+        meta = read_json(self.meta_path, {})
+        cached = self.catalog_path.exists()
+
+        # A fresh copy on disk (e.g. from the previous timer run) needs no request at all
+        if cached and now - meta.get('fetched_at', 0) < self.ttl:
+            if self._index is None:
+                self._load_from_disk()
+            self._checked_at = now
+            return
+
+        headers = {}
+        if cached:
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+
+        try:
+            response = self.session.get(self.url, headers=headers, timeout=self.timeout)
+            if response.status_code == 304 and cached:
+                logger.debug("AppleDB catalog not modified, reusing cached copy")
+                if self._index is None:
+                    self._load_from_disk()
+            else:
+                response.raise_for_status()
+                devices = response.json()
+                atomic_write(self.catalog_path, response.content)
+                self._index = self._build_index(devices)
+                logger.info(f"Downloaded AppleDB catalog ({len(response.content)} bytes, {len(self._index)} identifiers)")
+            write_json(self.meta_path, {
+                'fetched_at': now,
+                'etag': response.headers.get('ETag', meta.get('etag')),
+                'last_modified': response.headers.get('Last-Modified', meta.get('last_modified'))
+            })
+            self._checked_at = now
+        except (requests.RequestException, ValueError) as e:
+            if cached:
+                logger.warning(f"Could not revalidate AppleDB catalog, using cached copy: {e}")
+                if self._index is None:
+                    self._load_from_disk()
+                self._checked_at = now
+            else:
+                logger.warning(f"AppleDB catalog unavailable and no cached copy exists: {e}")
+                self._index = {}
+                # Retry sooner than the TTL so a transient outage doesn't disable images for a day
+                self._checked_at = now - self.ttl + COLD_RETRY_SECONDS
+
+    def _load_from_disk(self):
+        try:
+            with open(self.catalog_path, "rb") as f:
+                self._index = self._build_index(json.load(f))
+            get_logger().debug(f"Loaded AppleDB catalog from {self.catalog_path}")
+        except (OSError, ValueError) as e:
+            get_logger().warning(f"Cached AppleDB catalog is unreadable: {e}")
+            self._index = {}
+
+    @staticmethod
+    def _build_index(devices):
+        """Map every identifier and deviceMap entry to (device_key, default_color)."""
+        index = {}
+        for device in devices:
+            colors = device.get("colors", [])
+            color = colors[0]["key"] if colors and isinstance(colors[0], dict) and "key" in colors[0] else DEFAULT_COLOR
+            names = []
+            for field in ("identifier", "deviceMap"):
+                value = device.get(field) or []
+                names.extend([value] if isinstance(value, str) else value)
+            for name in names:
+                # The first device listing an identifier wins, as with the old linear scan
+                index.setdefault(name, (device.get("key", name), color))
+        return index
+
+
+_instances = {}
+
+
+def get_appledb(cache_dir="cache", ttl=86400):
+    """Get the process-wide AppleDB cache for a cache directory, so the catalog is parsed once."""
+    key = str(Path(cache_dir).resolve())
+    if key not in _instances:
+        _instances[key] = AppleDB(cache_dir, ttl)
+    _instances[key].ttl = ttl
+    return _instances[key]
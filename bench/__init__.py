@@ -0,0 +1,3 @@
+"""
+Benchmark harness: fake Mosyle and Snipe-IT servers and synthetic fleets (python -m bench.run).
+"""
@@ -0,0 +1,331 @@
+"""
+Local stand-ins for the Mosyle and Snipe-IT APIs, for benchmarking the sync.
+
+Each fake implements only the endpoints main.py and its clients call, keeps its data in
+memory, counts every request it serves, and can add latency, enforce a rate limit and
+inject 429/5xx responses.
+"""
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+# Model identifiers the synthetic fleet is drawn from, per Mosyle os type
+MODELS = {
+    "mac": ("MacBookPro18,3", "MacBookAir10,1", "Mac14,2", "Mac13,1", "iMac21,1", "Macmini9,1"),
+    "ios": ("iPad13,1", "iPad12,1", "iPad14,1", "iPhone14,5", "iPhone15,2"),
+    "tvos": ("AppleTV11,1", "AppleTV6,2"),
+}
+
+OS_VERSIONS = {"mac": ("13.6", "14.4", "14.5"), "ios": ("16.7", "17.4", "17.5"), "tvos": ("17.4",)}
+
+# Share of the fleet per os type, and of devices with a user assigned
+FLEET_MIX = (("mac", 0.5), ("ios", 0.4), ("tvos", 0.1))
+ASSIGNED_SHARE = 0.6
+
+# Mosyle listdevices page size
+MOSYLE_PAGE_SIZE = 50
+
+_ID = re.compile(r"/\d+(?=/|$)")
+
+
+def make_fleet(size, seed=1):
+    """
+    A deterministic synthetic Mosyle fleet.
+
+    Returns:
+        tuple: (dict of os type -> list of Mosyle device rows, list of user emails)
+    """
+    rand = random.Random(seed)
+    users = [f"user{i}@bench.example" for i in range(max(size // 10, 1))]
+    fleet = {os: [] for os, _ in FLEET_MIX}
+    for i in range(size):
+        point = rand.random()
+        for os, share in FLEET_MIX:
+            point -= share
+            if point < 0:
+                break
+        email = rand.choice(users) if rand.random() < ASSIGNED_SHARE else None
+        mac = ":".join(f"{rand.randrange(256):02x}" for _ in range(6))
+        fleet[os].append({
+            "serial_number": f"B{i:09d}",
+            "device_name": f"{os}-{i}",
+            "device_model": rand.choice(MODELS[os]),
+            "os": os,
+            "osversion": rand.choice(OS_VERSIONS[os]),
+            "cpu_model": "Apple M1" if os == "mac" else None,
+            "percent_disk": str(rand.randrange(5, 95)),
+            "available_disk": str(rand.randrange(10, 900)),
+            "wifi_mac_address": mac,
+            "bluetooth_mac_address": mac,
+            "ethernet_mac_address": None,
+            "useremail": email,
+            "CurrentConsoleManagedUser": email.split("@")[0] if email else None,
+            "asset_tag": None,
+            # Columns the sync doesn't read, so column projection has something to save
+            "date_info": "2024-01-01 00:00:00",
+            "last_beat": str(1700000000 + i),
+            "installed_apps": [{"name": f"App {n}", "version": "1.0"} for n in range(20)],
+        })
+    return fleet, users
+
+
+class Faults:
+    """
+    Latency, rate limiting and error injection shared by a fake server's handlers.
+
+    Args:
+        latency: Seconds added to every response
+        jitter: Up to this many extra seconds, chosen at random per request
+        rate_limit: Requests per minute served before answering 429 (0 for unlimited)
+        error_429: Share of requests answered 429 regardless of the rate limit
+        error_5xx: Share of requests answered 503
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, rate_limit=0, error_429=0.0, error_5xx=0.0, seed=1):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit = rate_limit
+        self.error_429 = error_429
+        self.error_5xx = error_5xx
+        self._rand = random.Random(seed)
+        self._lock = threading.Lock()
+        self._tokens = float(rate_limit)
+        self._refilled = time.monotonic()
+
+    def delay(self):
+        with self._lock:
+            extra = self._rand.random() * self.jitter if self.jitter else 0.0
+        if self.latency or extra:
+            time.sleep(self.latency + extra)
+
+    def check(self):
+        """Return (status, headers) to reject the request with, or None to serve it."""
+        with self._lock:
+            roll = self._rand.random()
+            if roll < self.error_5xx:
+                return 503, {}
+            if roll < self.error_5xx + self.error_429:
+                return 429, {"Retry-After": "1"}
+            if not self.rate_limit:
+                return None
+            now = time.monotonic()
+            self._tokens = min(self.rate_limit, self._tokens + (now - self._refilled) * self.rate_limit / 60)
+            self._refilled = now
+            headers = {"X-RateLimit-Limit": str(self.rate_limit)}
+            if self._tokens < 1:
+                wait = (1 - self._tokens) * 60 / self.rate_limit
+                headers.update({"X-RateLimit-Remaining": "0", "Retry-After": str(max(int(wait + 0.999), 1))})
+                return 429, headers
+            self._tokens -= 1
+            return None
+
+
+class FakeServer:
+    """A fake API on a background thread; `url` is set once started."""
+
+    def __init__(self, faults=None, host="127.0.0.1", port=0):
+        self.faults = faults or Faults()
+        self.counts = {}
+        self.lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name=type(self).__name__, daemon=True)
+        self.url = f"http://{host}:{self._server.server_address[1]}"
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def requests(self):
+        with self.lock:
+            return sum(self.counts.values())
+
+    def reset_counts(self):
+        with self.lock:
+            self.counts.clear()
+
+    def route(self, method, path, query, body):
+        """Return (status, body, headers) for a request that passed the fault checks."""
+        raise NotImplementedError
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Send headers and body in one segment; otherwise delayed ACKs add ~40ms to every keep-alive request
+            wbufsize = 1 << 16
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass
+
+            def _reply(self, status, body, headers=None):
+                data = json.dumps(body).encode("utf8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _handle(self):
+                url = urlparse(self.path)
+                length = int(self.headers.get("Content-Length") or 0)
+                raw = self.rfile.read(length) if length else b""
+                key = f"{self.command} {_ID.sub('/:id', url.path)}"
+                with server.lock:
+                    server.counts[key] = server.counts.get(key, 0) + 1
+
+                server.faults.delay()
+                rejected = server.faults.check()
+                if rejected:
+                    status, headers = rejected
+                    return self._reply(status, {"status": "error", "messages": "injected"}, headers)
+
+                content_type = self.headers.get("Content-Type", "")
+                body = json.loads(raw) if raw and content_type.startswith("application/json") else {}
+                query = {key: values[0] for key, values in parse_qs(url.query).items()}
+                status, payload, headers = server.route(self.command, url.path, query, body)
+                self._reply(status, payload, headers)
+
+            do_GET = do_POST = do_PATCH = do_DELETE = _handle
+
+        return Handler
+
+
+class FakeMosyle(FakeServer):
+    """Mosyle login, listdevices (paged, with specific_columns) and devices update_device."""
+
+    def __init__(self, fleet, faults=None, page_size=MOSYLE_PAGE_SIZE, **kwargs):
+        super().__init__(faults, **kwargs)
+        self.fleet = fleet
+        self.page_size = page_size
+        self.by_serial = {device["serial_number"]: device for devices in fleet.values() for device in devices}
+
+    def route(self, method, path, query, body):
+        if path.endswith("/login"):
+            return 200, {}, {"Authorization": "Bearer bench-jwt"}
+
+        if path.endswith("/listdevices"):
+            options = body.get("options", {})
+            devices = self.fleet.get(options.get("os"), [])
+            page = int(options.get("page", 1))
+            rows = devices[(page - 1) * self.page_size:page * self.page_size]
+            columns = options.get("specific_columns")
+            if columns:
+                rows = [{column: row[column] for column in columns if column in row} for row in rows]
+            return 200, {
+                "status": "OK",
+                "response": {"devices": rows, "rows": len(devices), "page_size": self.page_size, "page": page}
+            }, None
+
+        if path.endswith("/devices"):
+            elements = body.get("elements") or [body]
+            for element in elements:
+                device = self.by_serial.get(element.get("serialnumber"))
+                if device is not None:
+                    device["asset_tag"] = element.get("asset_tag")
+            return 200, {"status": "OK"}, None
+
+        return 404, {"status": "error"}, None
+
+
+class FakeSnipe(FakeServer):
+    """Snipe-IT hardware, models and users listing, creation, updates and checkout/checkin."""
+
+    def __init__(self, users, faults=None, **kwargs):
+        super().__init__(faults, **kwargs)
+        self.hardware = {}
+        self.by_serial = {}
+        self.models = {}
+        self.users = [
+            {"id": i + 1, "username": email, "email": email, "name": email.split("@")[0]}
+            for i, email in enumerate(users)
+        ]
+        self.users_by_id = {user["id"]: user for user in self.users}
+
+    @staticmethod
+    def _page(rows, query):
+        offset = int(query.get("offset", 0))
+        limit = int(query.get("limit", 50))
+        return 200, {"total": len(rows), "rows": rows[offset:offset + limit]}, None
+
+    def route(self, method, path, query, body):
+        path = path.split("/api/v1", 1)[-1]
+        with self.lock:
+            if method == "GET":
+                if path == "/hardware":
+                    archived = query.get("status") == "Archived"
+                    rows = [row for row in self.hardware.values() if row["archived"] == archived]
+                    return self._page(rows, query)
+                if path.startswith("/hardware/byserial/"):
+                    row = self.by_serial.get(path.rsplit("/", 1)[-1])
+                    return 200, {"total": int(row is not None), "rows": [row] if row else []}, None
+                if path == "/models":
+                    rows = list(self.models.values())
+                    if query.get("search"):
+                        rows = [row for row in rows if query["search"].lower() in row["name"].lower()]
+                    return self._page(rows, query)
+                if path == "/users":
+                    rows = self.users
+                    if query.get("search"):
+                        rows = [row for row in rows if query["search"].lower() in row["email"].lower()]
+                    return self._page(rows, query)
+
+            if method == "POST" and path == "/models":
+                model_id = len(self.models) + 1
+                row = {"id": model_id, "name": body["name"], "model_number": body.get("model_number"), "image": None}
+                self.models[model_id] = row
+                return 200, {"status": "success", "payload": row}, None
+
+            if method == "POST" and path == "/hardware":
+                if body.get("serial") in self.by_serial:
+                    return 200, {"status": "error", "messages": {"serial": ["The serial must be unique."]}}, None
+                asset_id = len(self.hardware) + 1
+                row = {
+                    "id": asset_id, "serial": body.get("serial"), "name": body.get("name"),
+                    "asset_tag": body.get("asset_tag") or str(asset_id), "archived": False,
+                    "model": {"id": body.get("model_id")}, "assigned_to": None, "custom_fields": {},
+                }
+                self._apply(row, body)
+                self.hardware[asset_id] = row
+                self.by_serial[row["serial"]] = row
+                return 200, {"status": "success", "payload": {"id": asset_id, "asset_tag": row["asset_tag"]}}, None
+
+            match = re.match(r"/hardware/(\d+)(?:/(checkout|checkin))?$", path)
+            row = self.hardware.get(int(match.group(1))) if match else None
+            if row is not None and method == "PATCH" and not match.group(2):
+                self._apply(row, body)
+                return 200, {"status": "success", "payload": {"id": row["id"]}}, None
+            if row is not None and match.group(2) == "checkin":
+                row["assigned_to"] = None
+                return 200, {"status": "success"}, None
+            if row is not None and match.group(2) == "checkout":
+                user = self.users_by_id.get(body.get("assigned_user"))
+                if user is None:
+                    return 200, {"status": "error", "messages": "User not found"}, None
+                row["assigned_to"] = {"id": user["id"], "username": user["username"], "email": user["email"], "type": "user"}
+                return 200, {"status": "success"}, None
+
+        return 404, {"status": "error", "messages": "Not found"}, None
+
+    @staticmethod
+    def _apply(row, body):
+        for key, value in body.items():
+            if key.startswith("_snipeit_"):
+                row["custom_fields"][key] = {"field": key, "value": value}
+            elif key == "model_id":
+                row["model"] = {"id": value}
+            elif key not in ("status_id",):
+                row[key] = value
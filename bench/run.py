@@ -0,0 +1,172 @@
+"""
+Benchmark run_sync against the local fakes with synthetic fleets.
+
+    python -m bench.run                          # 1k, 10k and 50k devices
+    python -m bench.run --fleet 1000 --workers 8 --latency 0.02 --snipe-rate-limit 6000
+
+For each fleet size the fakes are started in this process and every pass of the sync runs
+in a child process, so its peak RSS is its own. Pass 1 creates the fleet in Snipe-IT;
+later passes measure a steady-state run against an up-to-date Snipe-IT.
+"""
+import argparse
+import configparser
+import json
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from bench.fakes import FakeMosyle, FakeSnipe, Faults, make_fleet
+
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def write_settings(path, mosyle_url, snipe_url, cache_dir, args):
+    config = configparser.ConfigParser()
+    config['mosyle'] = {
+        'url': mosyle_url,
+        'token': 'bench',
+        'user': 'bench@bench.example',
+        'password': 'bench',
+        'deviceTypes': 'mac,ios,tvos',
+        'calltype': 'all',
+        'fetch_concurrency': str(args.fetch_concurrency),
+        'page_workers': str(args.page_workers),
+        'bulk_tag_update': str(args.bulk_tags),
+    }
+    config['snipe-it'] = {
+        'url': f"{snipe_url}/api/v1",
+        'apikey': 'bench',
+        'manufacturer_id': '1',
+        'macos_category_id': '2',
+        'ios_category_id': '3',
+        'tvos_category_id': '4',
+        'macos_fieldset_id': '1',
+        'ios_fieldset_id': '1',
+        'tvos_fieldset_id': '1',
+        'rate_limit': str(args.client_rate_limit),
+        'apple_image_check': 'False',
+        'adaptive_limits': str(args.adaptive > 0),
+        'max_rate_limit': str(args.adaptive),
+    }
+    config['api-mapping'] = {}
+    config['cache'] = {'cache_dir': str(cache_dir)}
+    config['metrics'] = {'textfile': str(Path(cache_dir) / 'bench.prom')}
+    with open(path, 'w') as f:
+        config.write(f)
+
+
+def child(settings, workers, result_path):
+    """Run one sync in this process and write its timing and peak RSS to result_path."""
+    sys.path.insert(0, str(ROOT))
+    from logger_config import setup_logging
+    from main import load_configuration, run_sync
+
+    setup_logging(log_dir=str(Path(result_path).parent / "logs"), log_level="WARNING")
+    config = load_configuration(settings)
+    started = time.monotonic()
+    processed = run_sync(config, workers=workers)
+    wall = time.monotonic() - started
+    # ru_maxrss is KiB on Linux and bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    rss_mb = maxrss / 1024 / 1024 if sys.platform == "darwin" else maxrss / 1024
+    with open(result_path, 'w') as f:
+        json.dump({"wall": wall, "processed": processed, "rss_mb": rss_mb}, f)
+
+
+def run_pass(settings, workers, work_dir, verbose):
+    result_path = Path(work_dir) / "result.json"
+    command = [sys.executable, "-m", "bench.run", "--child", str(settings), "--workers", str(workers),
+               "--result", str(result_path)]
+    output = None if verbose else subprocess.DEVNULL
+    subprocess.run(command, cwd=ROOT, stdout=output, stderr=output, check=True)
+    with open(result_path) as f:
+        return json.load(f)
+
+
+def bench_fleet(size, args):
+    fleet, users = make_fleet(size, seed=args.seed)
+    mosyle = FakeMosyle(fleet, Faults(args.latency, args.jitter, 0, args.mosyle_429, args.mosyle_5xx, args.seed)).start()
+    snipe = FakeSnipe(users, Faults(
+        args.latency, args.jitter, args.snipe_rate_limit, args.snipe_429, args.snipe_5xx, args.seed
+    )).start()
+    rows = []
+    try:
+        with tempfile.TemporaryDirectory(prefix="mosylesnipe-bench-") as work_dir:
+            settings = Path(work_dir) / "settings.ini"
+            write_settings(settings, mosyle.url, snipe.url, Path(work_dir) / "cache", args)
+            for number in range(1, args.passes + 1):
+                mosyle.reset_counts()
+                snipe.reset_counts()
+                result = run_pass(settings, args.workers, work_dir, args.verbose)
+                requests = mosyle.requests() + snipe.requests()
+                rows.append({
+                    "devices": size,
+                    "pass": number,
+                    "wall_s": round(result["wall"], 2),
+                    "processed": result["processed"],
+                    "mosyle_requests": mosyle.requests(),
+                    "snipe_requests": snipe.requests(),
+                    "requests_per_device": round(requests / size, 3),
+                    "devices_per_s": round(size / result["wall"], 1) if result["wall"] else None,
+                    "peak_rss_mb": round(result["rss_mb"], 1),
+                })
+                print(format_row(rows[-1]), flush=True)
+    finally:
+        mosyle.stop()
+        snipe.stop()
+    return rows
+
+
+COLUMNS = (
+    ("devices", 8), ("pass", 5), ("wall_s", 9), ("processed", 10), ("mosyle_requests", 16),
+    ("snipe_requests", 15), ("requests_per_device", 20), ("devices_per_s", 14), ("peak_rss_mb", 12),
+)
+
+
+def format_row(row):
+    return "".join(f"{row[name]!s:>{width}}" for name, width in COLUMNS)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the sync against local fake Mosyle and Snipe-IT servers")
+    parser.add_argument('--fleet', type=int, nargs='+', default=[1000, 10000, 50000], help='Fleet sizes (default: 1000 10000 50000)')
+    parser.add_argument('--passes', type=int, default=2, help='Sync runs per fleet; pass 1 creates every asset (default: 2)')
+    parser.add_argument('--workers', type=int, default=8, help='--workers for the sync (default: 8)')
+    parser.add_argument('--fetch-concurrency', type=int, default=2, help='[mosyle] fetch_concurrency (default: 2)')
+    parser.add_argument('--page-workers', type=int, default=2, help='[mosyle] page_workers (default: 2)')
+    parser.add_argument('--bulk-tags', action='store_true', help='Set [mosyle] bulk_tag_update')
+    parser.add_argument('--client-rate-limit', type=int, default=100000, help='[snipe-it] rate_limit, requests/minute (default: 100000)')
+    parser.add_argument('--adaptive', type=int, default=0, metavar='MAX', help='Enable [snipe-it] adaptive_limits up to MAX requests/minute, starting from --client-rate-limit')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every fake response (default: 0)')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Up to this many extra seconds per response (default: 0)')
+    parser.add_argument('--snipe-rate-limit', type=int, default=0, help='Requests/minute the fake Snipe-IT serves before 429 (default: unlimited)')
+    parser.add_argument('--snipe-429', type=float, default=0.0, help='Share of Snipe-IT requests answered 429')
+    parser.add_argument('--snipe-5xx', type=float, default=0.0, help='Share of Snipe-IT requests answered 503 (the client waits 60s per retry)')
+    parser.add_argument('--mosyle-429', type=float, default=0.0, help='Share of Mosyle requests answered 429')
+    parser.add_argument('--mosyle-5xx', type=float, default=0.0, help='Share of Mosyle requests answered 503')
+    parser.add_argument('--seed', type=int, default=1, help='Fleet and fault injection seed (default: 1)')
+    parser.add_argument('--json', metavar='FILE', help='Also write the results to FILE as JSON')
+    parser.add_argument('--verbose', action='store_true', help='Show the sync output')
+    parser.add_argument('--child', metavar='SETTINGS', help=argparse.SUPPRESS)
+    parser.add_argument('--result', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child, args.workers, args.result)
+        return
+
+    print("".join(f"{name:>{width}}" for name, width in COLUMNS))
+    rows = []
+    for size in args.fleet:
+        rows += bench_fleet(size, args)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(rows, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+"""
+Small helpers for the on-disk caches kept under the configured cache directory.
+"""
+import json
+import os
+import tempfile
+from pathlib import Path
+
+
+def atomic_write(path, data):
+    """
+    Write bytes to a file atomically so readers never see a half-written cache entry.
+
+    Args:
+        path: Destination file path (parent directories are created)
+        data: Bytes to write
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=path.name + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as tmp:
+            tmp.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def read_json(path, default=None):
+    """Read a JSON cache file, returning `default` if it is missing or unreadable."""
+    try:
+        with open(path, "rb") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+
+def write_json(path, data):
+    """Atomically write `data` as JSON."""
+    atomic_write(path, json.dumps(data).encode("utf8"))
@@ -0,0 +1,285 @@
+"""
+Record/replay cassettes of Mosyle and Snipe-IT traffic.
+
+--record DIR saves every request the two API clients make, with its response and latency,
+to DIR/cassette.jsonl.gz. --replay DIR answers the same requests from the cassette instead
+of the network, so a production-shaped run can be repeated offline to compare request
+counts and wall time across code changes.
+
+The cassette hooks in as the clients' transport adapter, below Mosyle._post and
+Snipe.snipeItRequest, so retries, the rate limiter and metrics behave in a replay exactly
+as they did live. Secrets are never written: request headers aren't stored, credentials
+are dropped from request bodies before they are keyed, and bearer tokens in response
+headers are redacted. Response bodies are stored as returned and hold fleet and user data.
+"""
+import gzip
+import hashlib
+import json
+import shutil
+import sqlite3
+import threading
+import time
+from collections import Counter, deque
+from pathlib import Path
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+from logger_config import get_logger
+
+
+CASSETTE_FILE = "cassette.jsonl.gz"
+STATE_FILE = "state.sqlite3"
+
+# Request body fields holding credentials, dropped before a request is keyed
+SECRET_FIELDS = frozenset(("accessToken", "password", "email", "apiKey", "token"))
+
+# Mosyle listdevices options that change from run to run without changing what is asked for
+VOLATILE_OPTIONS = frozenset(("start", "end"))
+
+# Response headers worth keeping: the clients read these, everything else is noise
+KEPT_HEADERS = ("content-type", "authorization", "retry-after", "x-ratelimit-limit", "x-ratelimit-remaining",
+                "x-ratelimit-reset", "etag", "last-modified")
+
+
+def _request_path(request, base_url):
+    """Path of a request relative to the client's base URL, with sorted query parameters."""
+    url = urlsplit(request.url)
+    base_path = urlsplit(base_url).path.rstrip("/")
+    path = url.path[len(base_path):] if base_path and url.path.startswith(base_path) else url.path
+    query = urlencode(sorted(parse_qsl(url.query, keep_blank_values=True)))
+    return f"{path}?{query}" if query else path
+
+
+def _request_body(request):
+    """Request body with credentials removed, in a stable form; empty for non-JSON bodies."""
+    if not request.body or "json" not in (request.headers.get("Content-Type") or ""):
+        return ""
+    body = request.body.decode("utf8") if isinstance(request.body, bytes) else request.body
+    try:
+        data = json.loads(body)
+    except ValueError:
+        return ""
+    if isinstance(data, dict):
+        data = {key: value for key, value in data.items() if key not in SECRET_FIELDS}
+        if isinstance(data.get("options"), dict):
+            data["options"] = {key: value for key, value in data["options"].items() if key not in VOLATILE_OPTIONS}
+    return json.dumps(data, sort_keys=True, separators=(",", ":"))
+
+
+def _request_key(service, method, path, body):
+    return hashlib.sha1(f"{service} {method} {path} {body}".encode("utf8")).hexdigest()
+
+
+def _scrub_headers(headers):
+    kept = {}
+    for key in KEPT_HEADERS:
+        value = headers.get(key)
+        if value is None:
+            continue
+        if key == "authorization":
+            value = "Bearer REDACTED" if value.startswith("Bearer ") else "REDACTED"
+        kept[key] = value
+    return kept
+
+
+class Cassette:
+    """
+    One cassette directory, open for recording or replay.
+
+    Args:
+        directory: Cassette directory (created when recording)
+        mode: "record" or "replay"
+        latency_scale: Replay waits this multiple of each recorded latency; 0 replays without waiting
+    """
+
+    def __init__(self, directory, mode, latency_scale=1.0):
+        self.directory = Path(directory)
+        self.mode = mode
+        self.latency_scale = latency_scale
+        self.stats = Counter()
+        self._lock = threading.Lock()
+        self._started = time.monotonic()
+        if mode == "record":
+            self.directory.mkdir(parents=True, exist_ok=True)
+            # A new recording replaces whatever an earlier one left in the directory
+            self._file = gzip.open(self.directory / CASSETTE_FILE, "wt", encoding="utf8")
+        elif mode == "replay":
+            self._load()
+        else:
+            raise ValueError(f"Unknown cassette mode {mode!r}")
+
+    def _load(self):
+        # Exact matches by request key, then by method and path for requests whose body changed
+        self._exact = {}
+        self._loose = {}
+        with gzip.open(self.directory / CASSETTE_FILE, "rt", encoding="utf8") as f:
+            for line in f:
+                entry = json.loads(line)
+                self._exact.setdefault(entry["key"], deque()).append(entry)
+                self._loose.setdefault((entry["service"], entry["method"], entry["path"]), deque()).append(entry)
+                self.stats["recorded"] += 1
+
+    def adapter(self, service, base_url, **kwargs):
+        """Transport adapter for a client session that records to or replays from this cassette."""
+        adapter_class = RecordingAdapter if self.mode == "record" else ReplayAdapter
+        return adapter_class(self, service, base_url, **kwargs)
+
+    def record(self, service, method, path, body, response=None, error=None, elapsed=0.0):
+        entry = {
+            "t": round(time.monotonic() - self._started, 4),
+            "service": service,
+            "method": method,
+            "path": path,
+            "key": _request_key(service, method, path, body),
+            "elapsed": round(elapsed, 4),
+        }
+        if error is not None:
+            entry["error"] = f"{type(error).__name__}: {error}"
+        else:
+            entry["status"] = response.status_code
+            entry["headers"] = _scrub_headers(response.headers)
+            entry["body"] = response.content.decode(response.encoding or "utf8", errors="replace")
+        line = json.dumps(entry, separators=(",", ":")) + "\n"
+        with self._lock:
+            self._file.write(line)
+            self.stats["recorded"] += 1
+
+    def match(self, service, method, path, body):
+        """
+        The recorded entry for a request, or None.
+
+        Each recorded response is served once, in recorded order, per request key. Once a key
+        runs out its last response is repeated, so a change that sends a request more often
+        still gets an answer.
+        """
+        key = _request_key(service, method, path, body)
+        with self._lock:
+            for queue, kind in ((self._exact.get(key), "exact"), (self._loose.get((service, method, path)), "loose")):
+                if not queue:
+                    continue
+                # Entries sit in both indexes; skip those already served through the other one
+                while len(queue) > 1 and queue[0].get("served"):
+                    queue.popleft()
+                entry = queue.popleft() if len(queue) > 1 else queue[0]
+                entry["served"] = True
+                self.stats[f"replayed_{kind}"] += 1
+                return entry
+            self.stats["missed"] += 1
+            return None
+
+    def save_state(self, state_db):
+        """Copy the sync state store into the cassette, so a replay starts from the same state."""
+        if not Path(state_db).exists():
+            (self.directory / STATE_FILE).unlink(missing_ok=True)
+            return
+        source = sqlite3.connect(str(state_db))
+        target = sqlite3.connect(str(self.directory / STATE_FILE))
+        with target:
+            source.backup(target)
+        source.close()
+        target.close()
+
+    def restore_state(self, state_db):
+        """Put the recorded state store at `state_db`; returns False if the recording had none."""
+        recorded = self.directory / STATE_FILE
+        Path(state_db).unlink(missing_ok=True)
+        if not recorded.exists():
+            return False
+        Path(state_db).parent.mkdir(parents=True, exist_ok=True)
+        shutil.copyfile(recorded, state_db)
+        return True
+
+    def close(self):
+        logger = get_logger()
+        if self.mode == "record":
+            with self._lock:
+                self._file.close()
+            logger.info(f"Recorded {self.stats['recorded']} requests to {self.directory / CASSETTE_FILE}")
+        else:
+            logger.info(
+                f"Replayed {self.stats['replayed_exact']} requests exactly and {self.stats['replayed_loose']} "
+                f"by path from {self.stats['recorded']} recorded; {self.stats['missed']} requests were not in the cassette"
+            )
+
+
+class RecordingAdapter(HTTPAdapter):
+    """Sends requests as usual and writes each exchange to the cassette."""
+
+    def __init__(self, cassette, service, base_url, **kwargs):
+        super().__init__(**kwargs)
+        self.cassette = cassette
+        self.service = service
+        self.base_url = base_url
+
+    def send(self, request, **kwargs):
+        path = _request_path(request, self.base_url)
+        body = _request_body(request)
+        started = time.monotonic()
+        try:
+            response = super().send(request, **kwargs)
+        except requests.RequestException as e:
+            self.cassette.record(self.service, request.method, path, body, error=e, elapsed=time.monotonic() - started)
+            raise
+        # Reading the body here is what a caller would do next; it stays cached on the response
+        response.content
+        self.cassette.record(self.service, request.method, path, body, response, elapsed=time.monotonic() - started)
+        return response
+
+
+class ReplayAdapter(HTTPAdapter):
+    """Answers requests from the cassette without touching the network."""
+
+    def __init__(self, cassette, service, base_url, **kwargs):
+        super().__init__(**kwargs)
+        self.cassette = cassette
+        self.service = service
+        self.base_url = base_url
+
+    def send(self, request, **kwargs):
+        path = _request_path(request, self.base_url)
+        entry = self.cassette.match(self.service, request.method, path, _request_body(request))
+        if entry is None:
+            get_logger().warning(f"No recorded {self.service} response for {request.method} {path}")
+            return self._response(request, 404, {"content-type": "application/json"}, '{"status": "error", "messages": "Not in cassette"}')
+        if self.cassette.latency_scale and entry["elapsed"]:
+            time.sleep(entry["elapsed"] * self.cassette.latency_scale)
+        if "error" in entry:
+            raise requests.ConnectionError(f"Replayed: {entry['error']}", request=request)
+        return self._response(request, entry["status"], entry["headers"], entry["body"])
+
+    @staticmethod
+    def _response(request, status, headers, body):
+        response = requests.Response()
+        response.status_code = status
+        response.headers = CaseInsensitiveDict(headers)
+        response._content = body.encode("utf8")
+        response.encoding = "utf8"
+        response.url = request.url
+        response.request = request
+        response.reason = "Replayed"
+        return response
+
+
+_cassette = None
+
+
+def use_cassette(directory, mode, latency_scale=1.0):
+    """Open a cassette that every Mosyle and Snipe client created afterwards will use."""
+    global _cassette
+    _cassette = Cassette(directory, mode, latency_scale)
+    return _cassette
+
+
+def get_cassette():
+    """The cassette in use, or None for live traffic."""
+    return _cassette
+
+
+def transport_adapter(service, base_url, **kwargs):
+    """The adapter a client should mount: a cassette's when one is in use, otherwise a plain HTTPAdapter."""
+    if _cassette is not None:
+        return _cassette.adapter(service, base_url, **kwargs)
+    return HTTPAdapter(**kwargs)
@@ -0,0 +1,88 @@
+"""
+Compact device records built from Mosyle listdevices pages.
+"""
+import hashlib
+import sys
+
+from snipe import PAYLOAD_COLUMNS
+
+
+# Mosyle device attributes read by sync_device for model lookup, user assignment and asset tags
+SYNC_COLUMNS = (
+    "serial_number",
+    "device_model",
+    "os",
+    "useremail",
+    "CurrentConsoleManagedUser",
+    "asset_tag",
+)
+
+# Every attribute a DeviceRecord keeps; anything else Mosyle returns is dropped
+RECORD_COLUMNS = tuple(dict.fromkeys(SYNC_COLUMNS + PAYLOAD_COLUMNS))
+
+# Values repeated across most of a fleet, stored once per process
+INTERNED_COLUMNS = frozenset(("os", "device_model", "osversion", "cpu_model"))
+
+
+class DeviceRecord:
+    """
+    One Mosyle device, holding only the attributes the sync reads.
+
+    Supports the dict-style access (record['os'], record.get(...), 'useremail' in record) that
+    sync_device and Snipe.buildPayloadFromMosyle use on raw Mosyle rows.
+    """
+
+    __slots__ = RECORD_COLUMNS + ("extra", "_fingerprint")
+
+    @classmethod
+    def from_mosyle(cls, device, extra_columns=()):
+        """
+        Build a record from a parsed listdevices row.
+
+        Args:
+            device: Device dict from a Mosyle page
+            extra_columns: Further attributes to keep besides RECORD_COLUMNS
+
+        Returns:
+            DeviceRecord
+        """
+        record = cls.__new__(cls)
+        for column in RECORD_COLUMNS:
+            value = device.get(column)
+            if column in INTERNED_COLUMNS and isinstance(value, str):
+                value = sys.intern(value)
+            setattr(record, column, value)
+        # Extra columns, e.g. from [api-mapping]; None when there are none, to save a dict per device
+        extra = {column: device.get(column) for column in extra_columns if column not in RECORD_COLUMNS}
+        record.extra = extra or None
+        record._fingerprint = None
+        return record
+
+    def __getitem__(self, key):
+        if key in RECORD_COLUMNS:
+            return getattr(self, key)
+        if self.extra and key in self.extra:
+            return self.extra[key]
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            value = self[key]
+        except KeyError:
+            return default
+        return value
+
+    def __contains__(self, key):
+        return key in RECORD_COLUMNS or bool(self.extra and key in self.extra)
+
+    def fingerprint(self):
+        """Hash of every kept attribute, used to detect changes since the last sync."""
+        if self._fingerprint is None:
+            values = tuple(getattr(self, column) for column in RECORD_COLUMNS)
+            if self.extra:
+                values += tuple(sorted(self.extra.items()))
+            self._fingerprint = hashlib.sha256(repr(values).encode("utf8")).hexdigest()
+        return self._fingerprint
+
+    def __repr__(self):
+        return f"DeviceRecord(serial_number={self.serial_number!r}, os={self.os!r}, device_model={self.device_model!r})"
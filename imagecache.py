@@ -0,0 +1,187 @@
+"""
+Content-addressed cache of AppleDB model images.
+Images are keyed by (device_key, color, size); the bytes are stored once per SHA-256 on disk
+and evicted least-recently-used once the store grows past its size bound.
+"""
+import base64
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from functools import cached_property
+from pathlib import Path
+
+import requests
+
+from cache import atomic_write, read_json, write_json
+from logger_config import get_logger
+
+
+IMAGE_URL = "https://img.appledb.dev/device@{size}/{device_key}/{color}.png"
+
+# How long a 404 from img.appledb.dev is remembered before the image is tried again
+MISS_TTL_SECONDS = 86400
+
+
+class ModelImage:
+    """Raw PNG bytes plus the encodings Snipe-IT accepts, computed once."""
+
+    def __init__(self, data, sha256):
+        self.data = data
+        self.sha256 = sha256
+
+    @cached_property
+    def data_url(self):
+        """Base64 data URL for the JSON `image` field of /models payloads."""
+        return "data:image/png;name=image.png;base64," + base64.b64encode(self.data).decode("utf8")
+
+    @property
+    def multipart(self):
+        """`files` argument for a multipart upload."""
+        return {"image": ("image.png", self.data, "image/png")}
+
+
+class ImageCache:
+    def __init__(self, cache_dir="cache", max_bytes=50 * 1024 * 1024, url=IMAGE_URL, timeout=(10, 30)):
+        self.root = Path(cache_dir) / "images"
+        self.max_bytes = max_bytes
+        self.url = url
+        self.timeout = timeout
+        self.session = requests.Session()
+        self._lock = threading.Lock()
+        # key -> {"sha256", "size", "used"} or {"missing": timestamp}
+        self._index = None
+        # sha256 -> ModelImage, most recently used last
+        self._memory = OrderedDict()
+
+    @property
+    def index_path(self):
+        return self.root / "index.json"
+
+    def _blob_path(self, sha256):
+        return self.root / f"{sha256}.png"
+
+    @staticmethod
+    def _key(device_key, color, size):
+        return f"{device_key}|{color}|{size}"
+
+    def get(self, device_key, color, size=256):
+        """
+        Return the image for an AppleDB device, downloading it only on a cache miss.
+
+        Args:
+            device_key: AppleDB device key
+            color: AppleDB color key
+            size: Rendered image width requested from img.appledb.dev
+
+        Returns:
+            ModelImage, or None if AppleDB has no image for this device and color
+        """
+        key = self._key(device_key, color, size)
+        with self._lock:
+            index = self._load_index()
+            entry = index.get(key)
+            if entry and 'missing' in entry and time.time() - entry['missing'] < MISS_TTL_SECONDS:
+                return None
+            if entry and 'sha256' in entry:
+                image = self._read(entry['sha256'])
+                if image is not None:
+                    # Recency only needs to be coarse for eviction, so skip rewriting the index on every hit
+                    if time.time() - entry['used'] > 3600:
+                        entry['used'] = time.time()
+                        self._save_index()
+                    return image
+
+        image = self._download(device_key, color, size)
+
+        with self._lock:
+            index = self._load_index()
+            if image is None:
+                index[key] = {'missing': time.time()}
+            else:
+                if not self._blob_path(image.sha256).exists():
+                    atomic_write(self._blob_path(image.sha256), image.data)
+                index[key] = {'sha256': image.sha256, 'size': len(image.data), 'used': time.time()}
+                self._remember(image)
+                self._evict()
+            self._save_index()
+        return image
+
+    def _download(self, device_key, color, size):
+        logger = get_logger()
+        url = self.url.format(size=size, device_key=device_key, color=color)
+        logger.debug(f"Downloading model image {url}")
+        try:
+            response = self.session.get(url, timeout=self.timeout)
+            if response.status_code == 404:
+                logger.info(f"AppleDB has no image at {url}")
+                return None
+            response.raise_for_status()
+        except requests.RequestException as e:
+            logger.warning(f"Error downloading model image {url}: {e}")
+            raise
+        return ModelImage(response.content, hashlib.sha256(response.content).hexdigest())
+
+    def _read(self, sha256):
+        image = self._memory.get(sha256)
+        if image is not None:
+            self._memory.move_to_end(sha256)
+            return image
+        try:
+            data = self._blob_path(sha256).read_bytes()
+        except OSError:
+            return None
+        if hashlib.sha256(data).hexdigest() != sha256:
+            get_logger().warning(f"Cached image {sha256} is corrupt, discarding it")
+            return None
+        image = ModelImage(data, sha256)
+        self._remember(image)
+        return image
+
+    def _remember(self, image):
+        self._memory[image.sha256] = image
+        self._memory.move_to_end(image.sha256)
+        while sum(len(i.data) for i in self._memory.values()) > self.max_bytes and len(self._memory) > 1:
+            self._memory.popitem(last=False)
+
+    def _evict(self):
+        """Drop least-recently-used keys until the distinct blobs on disk fit in max_bytes."""
+        index = self._index
+        blobs = {}
+        for entry in index.values():
+            if 'sha256' in entry:
+                used = blobs.get(entry['sha256'], (0, 0))[1]
+                blobs[entry['sha256']] = (entry['size'], max(used, entry['used']))
+        total = sum(size for size, _ in blobs.values())
+        for sha256, (size, _) in sorted(blobs.items(), key=lambda item: item[1][1]):
+            if total <= self.max_bytes:
+                break
+            for key in [k for k, e in index.items() if e.get('sha256') == sha256]:
+                del index[key]
+            self._memory.pop(sha256, None)
+            try:
+                self._blob_path(sha256).unlink()
+            except OSError:
+                pass
+            total -= size
+            get_logger().debug(f"Evicted cached image {sha256} ({size} bytes)")
+
+    def _load_index(self):
+        if self._index is None:
+            self._index = read_json(self.index_path, {})
+        return self._index
+
+    def _save_index(self):
+        write_json(self.index_path, self._index)
+
+
+_instances = {}
+
+
+def get_image_cache(cache_dir="cache", max_bytes=50 * 1024 * 1024):
+    """Get the process-wide image cache for a cache directory."""
+    key = str(Path(cache_dir).resolve())
+    if key not in _instances:
+        _instances[key] = ImageCache(cache_dir, max_bytes)
+    _instances[key].max_bytes = max_bytes
+    return _instances[key]
@@ -2,12 +2,23 @@
 Logging configuration for MosyleSnipeSync.
 Sets up structured logging with file and console handlers.
 """
+import atexit
+import hashlib
+import json
 import logging
 import logging.handlers
 import os
+import queue
 from pathlib import Path
 
 
+# Longest string logged as-is inside a payload, and longest rendered payload
+PAYLOAD_FIELD_LIMIT = 200
+PAYLOAD_LIMIT = 2000
+
+_listener = None
+
+
 def setup_logging(log_dir="logs", log_level="INFO"):
     """
     Configure logging with file rotation and console output.
@@ -26,6 +37,7 @@ def setup_logging(log_dir="logs", log_level="INFO"):
 
     # Remove any existing handlers to avoid duplicates
     logger.handlers.clear()
+    stop_logging()
 
     # File handler with rotation (10MB, keep 10 files)
     file_handler = logging.handlers.RotatingFileHandler(
@@ -48,13 +60,62 @@ def setup_logging(log_dir="logs", log_level="INFO"):
     file_handler.setFormatter(formatter)
     console_handler.setFormatter(formatter)
 
-    # Add handlers to logger
-    logger.addHandler(file_handler)
-    logger.addHandler(console_handler)
+    # Sync threads only enqueue records; a listener thread does the file and console I/O
+    global _listener
+    log_queue = queue.SimpleQueue()
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    _listener = logging.handlers.QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+    _listener.start()
 
     return logger
 
 
+def stop_logging():
+    """Flush queued records and stop the listener thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(stop_logging)
+
+
+class LogPayload:
+    """
+    Render an API payload for a log message, only if the message is actually emitted.
+
+    Strings longer than PAYLOAD_FIELD_LIMIT (base64 images, whole responses) are replaced by
+    their length and a short hash, and the result is cut at PAYLOAD_LIMIT characters.
+
+        logger.debug("Creating model with payload %s", LogPayload(payload))
+    """
+
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+    @classmethod
+    def _shorten(cls, value):
+        if isinstance(value, dict):
+            return {key: cls._shorten(item) for key, item in value.items()}
+        if isinstance(value, (list, tuple)):
+            return [cls._shorten(item) for item in value]
+        if isinstance(value, bytes):
+            value = value.decode("utf8", errors="replace")
+        if isinstance(value, str) and len(value) > PAYLOAD_FIELD_LIMIT:
+            digest = hashlib.sha256(value.encode("utf8")).hexdigest()[:12]
+            return f"<{len(value)} chars sha256:{digest}>"
+        return value
+
+    def __str__(self):
+        rendered = json.dumps(self._shorten(self.value), default=str)
+        if len(rendered) > PAYLOAD_LIMIT:
+            rendered = rendered[:PAYLOAD_LIMIT] + f"... ({len(rendered)} chars)"
+        return rendered
+
+
 def get_logger():
     """Get the configured logger instance."""
     return logging.getLogger("mosyle_snipe_sync")
@@ -4,21 +4,42 @@ Synchronizes Apple device data from Mosyle to Snipe-IT.
 Can run as a one-time sync or as a scheduled daemon.
 """
 import json
+import re
 import datetime
 import configparser
 import argparse
 import time
 import sys
 import os
+import tempfile
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED, ALL_COMPLETED
 from pathlib import Path
 from rich.progress import Progress
 from rich.console import Console
 
-from mosyle import Mosyle
+from mosyle import Mosyle, MosyleError, AssetTagQueue
 from snipe import Snipe
+from device import DeviceRecord, RECORD_COLUMNS
+from appledb import get_appledb
+from imagecache import get_image_cache
+from state import SyncState, fingerprint
+from plan import ChangePlan, plan_device, apply_actions, apply_plan, MODEL_OS
+from metrics import get_metrics
+from profiling import profile_run
+from cassette import use_cassette, get_cassette
+from shard import parse_shard, shard_of, shard_config, launch_shards, report_to_launcher
 from logger_config import setup_logging, get_logger
 
 
+# Mosyle pages downloaded ahead of the page being processed
+MOSYLE_PREFETCH_PAGES = 2
+
+# Minimum seconds between checkpoints of a run's progress; an interrupted run repeats at most this much work
+CHECKPOINT_SECONDS = 15
+CHECKPOINT_VERSION = 1
+
+
 def load_configuration(config_file='settings.ini'):
     """Load configuration from settings.ini."""
     logger = get_logger()
@@ -39,6 +60,12 @@ def load_configuration(config_file='settings.ini'):
         mosyle_password = config['mosyle']['password']
         deviceTypes = config['mosyle']['deviceTypes'].split(',')
         calltype = config['mosyle'].get('calltype', 'all')
+        delta_overlap = config['mosyle'].getint('delta_overlap_seconds', 600)
+        fetch_concurrency = config['mosyle'].getint('fetch_concurrency', 2)
+        page_workers = config['mosyle'].getint('page_workers', 1)
+        column_projection = config['mosyle'].getboolean('column_projection', True)
+        tag_batch_size = config['mosyle'].getint('tag_batch_size', 50)
+        bulk_tag_update = config['mosyle'].getboolean('bulk_tag_update', False)
     except KeyError as e:
         logger.error(f"Missing required Mosyle configuration: {e}")
         raise ValueError(f"Missing required Mosyle configuration: {e}")
@@ -61,10 +88,41 @@ def load_configuration(config_file='settings.ini'):
         tvos_fieldset_id = config['snipe-it']['tvos_fieldset_id']
         snipe_rate_limit = int(config['snipe-it']['rate_limit'])
         apple_image_check = config['snipe-it'].getboolean('apple_image_check')
+        # 0 sizes the connection pool to the --workers count
+        snipe_pool_size = config['snipe-it'].getint('pool_size', 0)
+        snipe_connect_timeout = config['snipe-it'].getfloat('connect_timeout', 10)
+        snipe_read_timeout = config['snipe-it'].getfloat('read_timeout', 60)
+        # Adaptive limits tune the rate and concurrency at runtime, up to these ceilings (0 = rate_limit / pool size)
+        snipe_adaptive = config['snipe-it'].getboolean('adaptive_limits', False)
+        snipe_max_rate_limit = config['snipe-it'].getint('max_rate_limit', 0)
+        snipe_max_concurrency = config['snipe-it'].getint('max_concurrency', 0)
+        snipe_latency_target = config['snipe-it'].getfloat('latency_target', 1.0)
     except KeyError as e:
         logger.error(f"Missing required configuration key: {e}")
         raise
 
+    # Local caches (AppleDB catalog, model images, ...) live under cache_dir
+    cache_dir = config.get('cache', 'cache_dir', fallback='cache')
+    appledb_ttl = config.getfloat('cache', 'appledb_ttl_hours', fallback=24) * 3600
+    image_cache_bytes = int(config.getfloat('cache', 'image_cache_mb', fallback=50) * 1024 * 1024)
+    user_cache_ttl = config.getfloat('cache', 'user_cache_ttl_minutes', fallback=0) * 60
+    state_db = config.get('cache', 'state_db', fallback=os.path.join(cache_dir, 'state.sqlite3'))
+    resume_window = config.getfloat('cache', 'resume_window_hours', fallback=12) * 3600
+
+    metrics_textfile = config.get('metrics', 'textfile', fallback=os.path.join(cache_dir, 'mosylesnipesync.prom'))
+    metrics_port = config.getint('metrics', 'http_port', fallback=0)
+
+    # [shard-1], [shard-2], ... give sharded runs their own Snipe-IT key and rate limit
+    shards = {}
+    for section in config.sections():
+        match = re.fullmatch(r"shard-(\d+)", section)
+        if match:
+            shards[int(match.group(1))] = {
+                'apiKey': config[section].get('apiKey'),
+                'rate_limit': config[section].getint('rate_limit'),
+                'max_rate_limit': config[section].getint('max_rate_limit')
+            }
+
     logger.info("Configuration loaded successfully")
 
     return {
@@ -74,7 +132,13 @@ def load_configuration(config_file='settings.ini'):
             'user': mosyle_user,
             'password': mosyle_password,
             'deviceTypes': deviceTypes,
-            'calltype': calltype
+            'calltype': calltype,
+            'delta_overlap': delta_overlap,
+            'fetch_concurrency': fetch_concurrency,
+            'page_workers': page_workers,
+            'column_projection': column_projection,
+            'tag_batch_size': tag_batch_size,
+            'bulk_tag_update': bulk_tag_update
         },
         'snipe': {
             'url': snipe_url,
@@ -87,25 +151,333 @@ def load_configuration(config_file='settings.ini'):
             'ios_fieldset_id': ios_fieldset_id,
             'tvos_fieldset_id': tvos_fieldset_id,
             'rate_limit': snipe_rate_limit,
-            'apple_image_check': apple_image_check
+            'apple_image_check': apple_image_check,
+            'pool_size': snipe_pool_size,
+            'connect_timeout': snipe_connect_timeout,
+            'read_timeout': snipe_read_timeout,
+            'adaptive_limits': snipe_adaptive,
+            'max_rate_limit': snipe_max_rate_limit,
+            'max_concurrency': snipe_max_concurrency,
+            'latency_target': snipe_latency_target
+        },
+        'api_mapping': dict(config['api-mapping']) if config.has_section('api-mapping') else {},
+        'cache': {
+            'cache_dir': cache_dir,
+            'appledb_ttl': appledb_ttl,
+            'image_cache_bytes': image_cache_bytes,
+            'user_cache_ttl': user_cache_ttl,
+            'state_db': state_db,
+            'resume_window': resume_window
+        },
+        'metrics': {
+            'textfile': metrics_textfile,
+            'http_port': metrics_port
+        },
+        'shards': shards
+    }
+
+
+def sync_device(snipe, tag_queue, sn, update_stats):
+    """
+    Sync a single Mosyle device to Snipe-IT.
+
+    Args:
+        snipe: Snipe client with its hardware, model and user indexes loaded
+        tag_queue: AssetTagQueue collecting asset tags to write back to Mosyle
+        sn: Device record from Mosyle
+        update_stats: Counter that receives the skipped/partial/full asset update result
+
+    Returns:
+        dict: The device's Snipe-IT hardware row after syncing, or None if it could not be synced
+
+    Raises:
+        ActionError: If Snipe-IT refused one of the changes
+    """
+    logger = get_logger()
+
+    # Look up or create model from the run-scoped catalog
+    with get_metrics().phase("model_resolve"):
+        model = snipe.getModelId(sn['device_model'], sn['os'])
+    if model is None:
+        logger.warning("Could not resolve model %s for %s, skipping", sn['device_model'], sn['serial_number'])
+        return None
+
+    # Work out what differs from Snipe-IT, then make those changes
+    actions = plan_device(snipe, sn, update_stats)
+    if actions is None:
+        return None
+    apply_actions(snipe, tag_queue, actions)
+    return snipe.findHardware(sn['serial_number'])
+
+
+def device_unchanged(snipe, state, sn, device_hash):
+    """
+    Check whether a device matches its last successful sync on both sides.
+
+    The Mosyle record must hash the same, the indexed Snipe-IT asset must still have the id,
+    asset tag and assigned user that were recorded, and Mosyle must already carry the tag.
+    """
+    previous = state.get(snipe.normalizeSerial(sn['serial_number']))
+    if previous is None or previous['payload_hash'] != device_hash:
+        return False
+    asset = snipe.findHardware(sn['serial_number'])
+    if asset is None or asset.get('id') != previous['asset_id']:
+        return False
+    # A tag that still needs writing back to Mosyle means the last write-back did not land
+    if asset.get('asset_tag') and sn.get('asset_tag') != asset.get('asset_tag'):
+        return False
+    assigned = asset.get('assigned_to') or {}
+    return asset.get('asset_tag') == previous['asset_tag'] and assigned.get('username') == previous['assigned_user']
+
+
+def process_device(snipe, tag_queue, state, sn, full_resync=False, after=None):
+    """
+    Sync one Mosyle record on a worker thread.
+
+    The clients, rate limiter and state store are shared between workers.
+
+    Args:
+        snipe: Snipe client with its indexes loaded
+        tag_queue: AssetTagQueue for asset tag write-backs
+        state: SyncState store
+        sn: Mosyle device record
+        full_resync: Process the record even if it is unchanged since the last sync
+        after: Future of an earlier record with the same serial, which must finish first
+
+    Returns:
+        Counter: processed/unchanged/errors device counts, skipped/partial/full update counts
+                 and the seconds spent
+    """
+    logger = get_logger()
+    outcome = Counter()
+    if after is not None:
+        wait([after])
+    started = time.monotonic()
+    try:
+        # Skip devices unchanged since their last successful sync
+        device_hash = fingerprint(sn)
+        if not full_resync and device_unchanged(snipe, state, sn, device_hash):
+            outcome['unchanged'] += 1
+            return outcome
+
+        asset = sync_device(snipe, tag_queue, sn, outcome)
+        if asset is None:
+            # Not in Snipe-IT and not recorded; an error keeps the watermark so the next delta retries it
+            logger.error("Could not sync device %s to Snipe-IT", sn['serial_number'])
+            outcome['errors'] += 1
+            return outcome
+        state.record(
+            snipe.normalizeSerial(sn['serial_number']),
+            asset.get('id'),
+            device_hash,
+            (asset.get('assigned_to') or {}).get('username'),
+            asset.get('asset_tag')
+        )
+        outcome['processed'] += 1
+
+    except Exception as e:
+        logger.error("Error processing device %s: %s", sn.get('serial_number', 'unknown'), e)
+        outcome['errors'] += 1
+    finally:
+        outcome['seconds'] += time.monotonic() - started
+    return outcome
+
+
+def sync_pages(snipe, tag_queue, state, pages, deviceTypes, workers=1, full_resync=False, first_pages=None,
+               resume_after=None, checkpoint=None, shard=None):
+    """
+    Stream Mosyle pages from every device type through the worker pool.
+
+    Pages are processed as they arrive, whichever type they belong to. Only a bounded number
+    of devices are queued at once, so memory stays at a few pages no matter how large the fleet is.
+
+    Args:
+        pages: Iterator from Mosyle.iterPagesByType()
+        deviceTypes: Mosyle os types being fetched
+        workers: Number of worker threads
+        first_pages: Dict of device type -> page a resumed fetch starts from
+        resume_after: Dict of device type -> serial on its first page; the devices up to and
+                      including it were synced before the interruption and are skipped
+        checkpoint: Optional callable given the results so far whenever a type's last fully
+                    synced page moves on, at most every CHECKPOINT_SECONDS, and once at the end
+        shard: Optional (index, count); devices whose serial hashes to another shard are skipped
+
+    Returns:
+        dict: Device type -> {'stats': Counter of outcomes, 'devices': devices seen,
+              'complete': whether every page was fetched, 'page' and 'serial': the last page
+              whose devices have all been synced and its last serial, 'done': whether the type
+              was fetched and synced to the end, 'seconds': wall time from its first page to
+              its last device synced}
+    """
+    logger = get_logger()
+    first_pages = first_pages or {}
+    resume_after = dict(resume_after or {})
+    results = {
+        deviceType: {
+            'stats': Counter(), 'devices': 0, 'complete': True, 'done': False,
+            'page': first_pages.get(deviceType, 1) - (deviceType not in resume_after),
+            'serial': resume_after.get(deviceType)
         }
+        for deviceType in deviceTypes
     }
+    started = time.monotonic()
+    finished = dict.fromkeys(deviceTypes, started)
+    max_in_flight = workers * 4 + 50
+    # future -> (device type, serial, page entry), and serial -> latest queued future, to keep each serial's records in order
+    in_flight = {}
+    latest = {}
+    # Per type, the pages not yet fully synced in fetch order, as [page, devices left, last serial]
+    open_pages = {deviceType: deque() for deviceType in deviceTypes}
+    fetched = set()
+    last_checkpoint = time.monotonic()
 
+    def advance(deviceType):
+        # Move the type's checkpoint past every leading page whose devices have all finished
+        result = results[deviceType]
+        moved = False
+        while open_pages[deviceType] and open_pages[deviceType][0][1] == 0:
+            result['page'], _, result['serial'] = open_pages[deviceType].popleft()
+            moved = True
+        if deviceType in fetched and not open_pages[deviceType] and not result['done']:
+            result['done'] = result['complete']
+            moved = True
+        return moved
 
-def run_sync(config):
+    def save_progress(force=False):
+        nonlocal last_checkpoint
+        if checkpoint is None or (not force and time.monotonic() - last_checkpoint < CHECKPOINT_SECONDS):
+            return
+        try:
+            checkpoint(results)
+        except Exception as e:
+            logger.warning(f"Could not save sync checkpoint: {e}")
+        last_checkpoint = time.monotonic()
+
+    def collect(return_when):
+        done, _ = wait(list(in_flight), return_when=return_when)
+        moved = False
+        for future in done:
+            deviceType, serial, entry = in_flight.pop(future)
+            if latest.get(serial) is future:
+                del latest[serial]
+            results[deviceType]['stats'].update(future.result())
+            finished[deviceType] = time.monotonic()
+            progress.advance(tasks[deviceType])
+            entry[1] -= 1
+            moved = advance(deviceType) or moved
+        if moved:
+            save_progress()
+
+    try:
+        with Progress() as progress:
+            tasks = {
+                deviceType: progress.add_task(f"[green]Processing {deviceType} devices...", total=None)
+                for deviceType in deviceTypes
+            }
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                try:
+                    for deviceType, page, devices, total, error in pages:
+                        result = results[deviceType]
+                        if page is None:
+                            # This type has no more pages
+                            if isinstance(error, MosyleError) and error.page == first_pages.get(deviceType, 1):
+                                logger.error(f"Mosyle API error for {deviceType}: {error}")
+                            elif isinstance(error, MosyleError):
+                                # Keep what was fetched, but don't let the watermark skip the missing pages
+                                logger.warning(f"Mosyle API error on page {error.page} for {deviceType}: {error}")
+                            elif error is not None:
+                                logger.error(f"Failed to fetch {deviceType} devices from Mosyle: {error}")
+                            result['complete'] = error is None
+                            fetched.add(deviceType)
+                            advance(deviceType)
+                            finished[deviceType] = max(finished[deviceType], time.monotonic())
+                            progress.update(tasks[deviceType], total=result['devices'])
+                            continue
+
+                        logger.debug("Retrieved %d %s devices from page %d", len(devices), deviceType, page)
+                        entry = [page, 0, None]
+                        open_pages[deviceType].append(entry)
+                        after = resume_after.pop(deviceType, None) if page == first_pages.get(deviceType) else None
+                        if after is not None:
+                            serials = [snipe.normalizeSerial(sn['serial_number']) if sn.get('serial_number') else None for sn in devices]
+                            if snipe.normalizeSerial(after) in serials:
+                                skipped = serials.index(snipe.normalizeSerial(after)) + 1
+                                logger.info(f"Skipping the first {skipped} {deviceType} devices on page {page}, synced before the interruption")
+                                result['devices'] += skipped
+                                progress.advance(tasks[deviceType], skipped)
+                                entry[2] = after
+                                devices = devices[skipped:]
+                            else:
+                                logger.warning(f"Serial {after} is no longer on {deviceType} page {page}, syncing the whole page again")
+                        for sn in devices:
+                            result['devices'] += 1
+                            if sn.get('serial_number') is None:
+                                logger.warning("%s device %d has no serial number, skipping", deviceType, result['devices'])
+                                progress.advance(tasks[deviceType])
+                                continue
+                            # The page's last serial, whichever shard it belongs to, is where a resumed run picks up
+                            entry[2] = sn['serial_number']
+                            serial = snipe.normalizeSerial(sn['serial_number'])
+                            if shard is not None and shard_of(serial, shard[1]) != shard[0]:
+                                result['stats']['other_shards'] += 1
+                                progress.advance(tasks[deviceType])
+                                continue
+                            future = pool.submit(process_device, snipe, tag_queue, state, sn, full_resync, latest.get(serial))
+                            entry[1] += 1
+                            in_flight[future] = (deviceType, serial, entry)
+                            latest[serial] = future
+                            while len(in_flight) >= max_in_flight:
+                                collect(FIRST_COMPLETED)
+                        advance(deviceType)
+                        progress.update(tasks[deviceType], total=total or result['devices'])
+                except Exception as e:
+                    logger.error(f"Failed to fetch devices from Mosyle: {e}")
+                    for result in results.values():
+                        result['complete'] = False
+                if in_flight:
+                    collect(ALL_COMPLETED)
+    finally:
+        # Also reached when the run is interrupted, so the next one resumes from here
+        save_progress(force=True)
+
+    for deviceType, result in results.items():
+        result['seconds'] = finished[deviceType] - started
+    return results
+
+
+def sync_columns(config):
     """
-    Execute a single synchronization run.
+    Work out the Mosyle columns the sync consumes, so listdevices can skip everything else.
+
+    Covers the DeviceRecord attributes, which are what buildPayloadFromMosyle and the sync
+    logic read, and the [api-mapping] section, whose right-hand side names the Mosyle
+    attribute (the last word, e.g. "general mac_address").
+
+    Returns:
+        list: Sorted column names, or None if column projection is disabled
+    """
+    if not config['mosyle']['column_projection']:
+        return None
+    columns = set(RECORD_COLUMNS)
+    for mosyle_field in config['api_mapping'].values():
+        if mosyle_field.split():
+            columns.add(mosyle_field.split()[-1])
+    return sorted(columns)
+
+
+def connect_clients(config, workers=1, models_only=False):
+    """
+    Connect to Mosyle and Snipe-IT and load the Snipe-IT indexes the sync reads from.
 
     Args:
         config: Configuration dictionary from load_configuration()
+        workers: Number of threads that will share the Snipe-IT connection pool
+        models_only: Load only the model catalog, not the hardware index or user directory
 
     Returns:
-        int: Total number of devices processed
+        tuple: (Mosyle client, Snipe client with its hardware, model and user indexes loaded)
     """
     logger = get_logger()
-    console = Console()
-
-    logger.info("=== Starting synchronization run ===")
 
     try:
         # Initialize Mosyle
@@ -113,13 +485,28 @@ def run_sync(config):
             config['mosyle']['token'],
             config['mosyle']['user'],
             config['mosyle']['password'],
-            config['mosyle']['url']
+            config['mosyle']['url'],
+            max_concurrency=config['mosyle']['fetch_concurrency']
         )
         logger.info("Successfully connected to Mosyle")
     except Exception as e:
         logger.error(f"Failed to connect to Mosyle: {e}")
         raise
 
+    pool_size = config['snipe']['pool_size'] or max(workers, 1)
+    adaptive = None
+    if config['snipe']['adaptive_limits']:
+        adaptive = {
+            'max_rate': config['snipe']['max_rate_limit'] or config['snipe']['rate_limit'],
+            # More requests in flight than pooled connections would only queue in urllib3
+            'max_concurrency': min(config['snipe']['max_concurrency'] or pool_size, pool_size),
+            'latency_target': config['snipe']['latency_target']
+        }
+        logger.info(
+            f"Adaptive Snipe-IT limits: up to {adaptive['max_rate']} requests/minute and "
+            f"{adaptive['max_concurrency']} in flight, latency target {adaptive['latency_target']}s"
+        )
+
     try:
         # Initialize Snipe-IT
         snipe = Snipe(
@@ -133,131 +520,497 @@ def run_sync(config):
             config['snipe']['macos_fieldset_id'],
             config['snipe']['ios_fieldset_id'],
             config['snipe']['tvos_fieldset_id'],
-            config['snipe']['apple_image_check']
+            config['snipe']['apple_image_check'],
+            appledb=get_appledb(config['cache']['cache_dir'], config['cache']['appledb_ttl']),
+            image_cache=get_image_cache(config['cache']['cache_dir'], config['cache']['image_cache_bytes']),
+            pool_size=pool_size,
+            timeout=(config['snipe']['connect_timeout'], config['snipe']['read_timeout']),
+            adaptive=adaptive
         )
         logger.info("Successfully connected to Snipe-IT")
     except Exception as e:
         logger.error(f"Failed to connect to Snipe-IT: {e}")
         raise
 
-    total_devices_processed = 0
-    ts = datetime.datetime.now().timestamp() - 200
+    if not models_only:
+        try:
+            # Prefetch all Apple hardware so per-device lookups need no request
+            snipe.loadHardwareIndex()
+            logger.info(f"Loaded {len(snipe.hardware_index)} Snipe-IT assets into the hardware index")
+        except Exception as e:
+            logger.error(f"Failed to load Snipe-IT hardware index: {e}")
+            raise
+
+    try:
+        # Load the model catalog so models are resolved by exact match without a search per device
+        snipe.loadModelCatalog()
+    except Exception as e:
+        logger.error(f"Failed to load Snipe-IT model catalog: {e}")
+        raise
+
+    if models_only:
+        return mosyle, snipe
+
+    try:
+        # Load users once so checkouts don't need a user search each
+        snipe.loadUserDirectory(
+            cache_path=Path(config['cache']['cache_dir']) / "users.json",
+            ttl=config['cache']['user_cache_ttl']
+        )
+    except Exception as e:
+        logger.error(f"Failed to load Snipe-IT user directory: {e}")
+        raise
+
+    return mosyle, snipe
+
+
+def should_resume(config, checkpoint, calltype, full_resync=False, resume=False):
+    """
+    Decide whether to continue from the checkpoint of an interrupted run.
+
+    A checkpoint is used if it is younger than the resume window, or at any age with
+    --resume. A full resync always starts afresh, and a full sweep doesn't continue an
+    interrupted delta run, which would cover fewer devices than asked for.
+    """
+    logger = get_logger()
+    if checkpoint.get('version') != CHECKPOINT_VERSION:
+        logger.info("Ignoring a checkpoint written by another version")
+        return False
+    started = datetime.datetime.fromtimestamp(checkpoint['started'])
+    age = time.time() - checkpoint['updated']
+    window = config['cache']['resume_window']
+    if full_resync:
+        logger.info(f"Full resync requested, not resuming the run started {started}")
+        return False
+    if checkpoint['calltype'] == "timestamp" and calltype == "all":
+        logger.info(f"Full sweep requested, not resuming the delta run started {started}")
+        return False
+    if not resume and age > window:
+        logger.info(
+            f"The run started {started} was interrupted {age / 3600:.1f} hours ago, outside the "
+            f"{window / 3600:g} hour resume window; starting afresh (use --resume to continue it)"
+        )
+        return False
+    return True
+
+
+def run_sync(config, full_resync=False, calltype=None, workers=1, resume=False, shard=None):
+    """
+    Execute a single synchronization run.
+
+    Progress is checkpointed in the state store as devices are synced. A run interrupted
+    part-way is continued by the next one within the resume window, from the page after
+    the last one fully synced, with the asset tag write-backs it still owed.
+
+    Args:
+        config: Configuration dictionary from load_configuration()
+        full_resync: Process every device even if it is unchanged since the last sync
+        calltype: Override the configured Mosyle calltype ("all" or "timestamp") for this run
+        workers: Number of threads syncing devices concurrently
+        resume: Continue an interrupted run even if its checkpoint is older than the resume window
+        shard: Optional (index, count) to sync only the devices in that shard, see shard.py
+
+    Returns:
+        int: Total number of devices processed
+    """
+    logger = get_logger()
+    console = Console()
+    metrics = get_metrics()
+
+    logger.info("=== Starting synchronization run ===")
+    if shard is not None:
+        logger.info(f"Syncing shard {shard[0]} of {shard[1]}")
+
+    with metrics.phase("index_load"):
+        mosyle, snipe = connect_clients(config, workers)
+
+    state = SyncState(config['cache']['state_db'])
+    if full_resync:
+        logger.info("Full resync requested, ignoring recorded sync state")
+
+    stats = Counter()
+    run_started = time.time()
+    calltype = "all" if full_resync else (calltype or config['mosyle']['calltype'])
+    logger.info(f"Fetch mode: {'delta' if calltype == 'timestamp' else 'full'}")
+
+    checkpoint, owed_tags = state.load_checkpoint()
+    if checkpoint is None and resume:
+        logger.info("No interrupted run to resume")
+    elif checkpoint is not None and not should_resume(config, checkpoint, calltype, full_resync, resume):
+        checkpoint = None
+    if checkpoint is not None:
+        # Watermarks settle at the interrupted run's start, which is what its pages reflect
+        run_started = checkpoint['started']
+        calltype = checkpoint['calltype']
+        logger.info(f"Resuming the run started {datetime.datetime.fromtimestamp(run_started)}")
+
+    # Work out the change window for each device type, from its watermark in delta mode
+    deviceTypes = [deviceType.strip() for deviceType in config['mosyle']['deviceTypes']]
+    sources = {}
+    for deviceType in deviceTypes:
+        watermark = state.get_meta(f"watermark:{deviceType}")
+        if calltype == "timestamp" and watermark is not None:
+            since = float(watermark) - config['mosyle']['delta_overlap']
+            logger.info(f"Fetching {deviceType} devices changed since {datetime.datetime.fromtimestamp(since)}")
+            sources[deviceType] = (since, run_started)
+        else:
+            if calltype == "timestamp":
+                logger.info(f"No watermark recorded for {deviceType} yet, fetching all devices")
+            sources[deviceType] = (None, None)
+
+    # Continue each type the interrupted run covered from its last fully synced page, refetched and
+    # skipped through its last serial, so devices shifted across the page boundary since aren't missed
+    progress = dict(checkpoint['types']) if checkpoint is not None else {}
+    first_pages = {}
+    resume_after = {}
+    for deviceType in deviceTypes:
+        saved = progress.get(deviceType)
+        if saved is None:
+            continue
+        if saved['done']:
+            logger.info(f"{deviceType} devices were finished before the interruption")
+            del sources[deviceType]
+            continue
+        sources[deviceType] = (saved['start'], saved['end'])
+        if saved['page'] and saved['serial']:
+            first_pages[deviceType] = saved['page']
+            resume_after[deviceType] = saved['serial']
+            logger.info(f"Resuming {deviceType} devices at page {saved['page']}, after serial {saved['serial']}")
+        else:
+            first_pages[deviceType] = saved['page'] + 1
+            logger.info(f"Resuming {deviceType} devices at page {saved['page'] + 1}")
+
+    columns = sync_columns(config)
+    logger.debug(f"Requesting Mosyle columns: {', '.join(columns) if columns else 'all'}")
+    # Pages are turned into compact records as they are parsed; api-mapping columns ride along as extras
+    extra_columns = [column for column in (columns or []) if column not in RECORD_COLUMNS]
+    make_record = lambda device: DeviceRecord.from_mosyle(device, extra_columns)
+
+    # Fetch every device type concurrently and process devices page by page as they arrive
+    pages = mosyle.iterPagesByType(
+        sources,
+        prefetch=MOSYLE_PREFETCH_PAGES,
+        page_workers=config['mosyle']['page_workers'],
+        specific_columns=columns,
+        make_record=make_record,
+        first_pages=first_pages
+    )
+    tag_queue = AssetTagQueue(
+        mosyle,
+        batch_size=config['mosyle']['tag_batch_size'],
+        bulk=config['mosyle']['bulk_tag_update']
+    )
+    if owed_tags:
+        # Tag write-backs a previous run queued but never got confirmed; the latest tag per serial still wins
+        logger.info(f"Sending {len(owed_tags)} asset tags left over from an interrupted run")
+        for serial, tag in owed_tags.items():
+            tag_queue.enqueue(serial, tag)
+
+    def save_checkpoint(results):
+        types = dict(progress)
+        for deviceType, (start, end) in sources.items():
+            result = results[deviceType]
+            previous = progress.get(deviceType, {})
+            types[deviceType] = {
+                'start': start,
+                'end': end,
+                'page': result['page'],
+                'serial': result['serial'] or previous.get('serial'),
+                'done': result['done'],
+                'errors': previous.get('errors', 0) + result['stats']['errors']
+            }
+        state.save_checkpoint(
+            {
+                'version': CHECKPOINT_VERSION,
+                'started': run_started,
+                'updated': time.time(),
+                'calltype': calltype,
+                'types': types
+            },
+            tag_queue.outstanding()
+        )
+
+    results = sync_pages(
+        snipe, tag_queue, state, pages, deviceTypes, workers, full_resync,
+        first_pages=first_pages, resume_after=resume_after, checkpoint=save_checkpoint, shard=shard
+    )
+
+    # Send the asset tags still queued before settling watermarks
+    with metrics.phase("tag_flush"):
+        tag_summary = tag_queue.flush()
+    tag_queue.close()
+
+    finished = True
+    for deviceType in deviceTypes:
+        result = results[deviceType]
+        type_stats = result['stats']
+        saved = progress.get(deviceType, {})
+        if deviceType not in sources:
+            result['done'] = True
+        finished = finished and result['done']
+        # Devices that failed before an interruption count against this run's watermark too
+        errors = type_stats['errors'] + saved.get('errors', 0)
+        stats.update(type_stats)
+        logger.info(f"Fetched {result['devices']} {deviceType} devices from Mosyle")
+        if shard is not None:
+            logger.info(f"{result['devices'] - type_stats['other_shards']} {deviceType} devices belong to this shard")
+        for outcome in ('processed', 'unchanged', 'errors'):
+            metrics.inc("devices_total", type_stats[outcome], device_type=deviceType, outcome=outcome)
+        metrics.inc("device_seconds_total", type_stats['seconds'], device_type=deviceType)
+        metrics.set("device_type_duration_seconds", result['seconds'], device_type=deviceType)
+
+        # Later deltas start from this run; the overlap window covers clock skew.
+        # Failed devices, pages or tag write-backs keep the old watermark so the next delta fetches them again.
+        if result['complete'] and errors == 0 and tag_summary['failed'] == 0:
+            state.set_meta(f"watermark:{deviceType}", run_started)
+        else:
+            logger.warning(
+                f"Not advancing the {deviceType} watermark: {errors} device errors, "
+                f"{tag_summary['failed']} failed tag write-backs, fetch complete: {result['complete']}"
+            )
+        logger.info(f"Finished {deviceType}: {type_stats['processed']} devices processed")
+
+    if finished:
+        state.clear_checkpoint()
+    else:
+        # A fetch stopped short; the next run picks up where it did
+        save_checkpoint(results)
+        logger.warning("Not every device type was fetched to the end; the next run resumes from the checkpoint")
+    state.close()
+    for result in ('skipped', 'partial', 'full'):
+        metrics.inc("asset_updates_total", stats[result], result=result)
+    for result in ('synced', 'failed', 'deduplicated'):
+        metrics.inc("asset_tags_total", tag_summary[result], result=result)
+    logger.info(f"Devices unchanged since last sync: {stats['unchanged']}, failed: {stats['errors']}")
+    logger.info(
+        f"Asset tags written to Mosyle: {tag_summary['synced']} synced, {tag_summary['failed']} failed, "
+        f"{tag_summary['deduplicated']} duplicates dropped"
+    )
+    logger.info(
+        f"Asset updates: {stats['skipped']} skipped, "
+        f"{stats['partial']} partial, {stats['full']} full"
+    )
+    logger.info(f"=== Synchronization run complete. Total devices processed: {stats['processed']} ===")
+    return stats['processed']
+
+
+def run_and_export(config, **kwargs):
+    """
+    Run run_sync() and write the metrics textfile afterwards, whether or not the run succeeded.
+
+    Returns:
+        int: Total number of devices processed
+    """
+    logger = get_logger()
+    metrics = get_metrics()
+    started = time.time()
+    success = False
+    try:
+        processed = run_sync(config, **kwargs)
+        success = True
+        return processed
+    finally:
+        metrics.set("run_duration_seconds", time.time() - started)
+        metrics.set("last_run_timestamp_seconds", time.time())
+        metrics.set("last_run_success", int(success))
+        if config['metrics']['textfile']:
+            try:
+                metrics.write_textfile(config['metrics']['textfile'])
+            except OSError as e:
+                logger.warning(f"Could not write metrics to {config['metrics']['textfile']}: {e}")
+
+
+def create_missing_models(config, full_resync=False, calltype=None):
+    """
+    Create the Snipe-IT models the fleet needs before a sharded run starts its shards.
 
+    Shards resolve models independently, so two shards meeting the same new model could both
+    create it. Run once from the launcher, this leaves the shards only models that already
+    exist. Just the model and os of each device are fetched; in delta mode only devices
+    changed since the last time this ran are, tracked by their own watermarks in the
+    launcher's state store. A model this misses is still created by the shard that needs it.
+
+    Returns:
+        int: Number of models created
+    """
+    logger = get_logger()
+    logger.info("Creating missing Snipe-IT models before starting the shards")
+    mosyle, snipe = connect_clients(config, models_only=True)
+    state = SyncState(config['cache']['state_db'])
+    started = time.time()
+    calltype = "all" if full_resync else (calltype or config['mosyle']['calltype'])
+
+    sources = {}
     for deviceType in config['mosyle']['deviceTypes']:
         deviceType = deviceType.strip()
-        logger.info(f"Processing device type: {deviceType}")
+        watermark = state.get_meta(f"model_watermark:{deviceType}")
+        if calltype == "timestamp" and watermark is not None:
+            sources[deviceType] = (float(watermark) - config['mosyle']['delta_overlap'], started)
+        else:
+            sources[deviceType] = (None, None)
 
-        try:
-            # Fetch devices from Mosyle
-            if config['mosyle']['calltype'] == "timestamp":
-                logger.debug(f"Using timestamp mode for {deviceType}")
-                mosyle_response = mosyle.listTimestamp(ts, ts, deviceType)
+    pages = mosyle.iterPagesByType(
+        sources,
+        prefetch=MOSYLE_PREFETCH_PAGES,
+        page_workers=config['mosyle']['page_workers'],
+        specific_columns=["serial_number", "device_model", "os"] if config['mosyle']['column_projection'] else None
+    )
+    models = {}
+    complete = set()
+    for deviceType, page, devices, total, error in pages:
+        if page is None:
+            if error is not None:
+                logger.error(f"Failed to fetch {deviceType} devices from Mosyle: {error}")
             else:
-                logger.debug(f"Using 'all' mode for {deviceType} (paginated)")
-                all_devices = []
-                page = 1
-                while True:
-                    response = mosyle.list(deviceType, page=page)
-                    devices = response.get('response', {}).get('devices', [])
-                    if not devices:
-                        break
-                    all_devices.extend(devices)
-                    logger.debug(f"Retrieved {len(devices)} devices from page {page}")
-                    page += 1
-                mosyle_response = {"status": "OK", "response": {"devices": all_devices}}
-
-            if mosyle_response.get('status') != "OK":
-                logger.error(f"Mosyle API error for {deviceType}: {mosyle_response.get('message')}")
-                continue
+                complete.add(deviceType)
+            continue
+        for device in devices:
+            if device.get('device_model') and device.get('os') in MODEL_OS:
+                models.setdefault(snipe.normalizeModel(device['device_model']), (device['device_model'], device['os'], deviceType))
 
-            devices = mosyle_response['response'].get('devices', [])
-            device_count = len(devices)
-            logger.info(f"Found {device_count} {deviceType} devices in Mosyle")
+    created = 0
+    failed = set()
+    for model, os_type, deviceType in models.values():
+        if snipe.findModel(model) is not None:
+            continue
+        if snipe.getModelId(model, os_type) is None:
+            failed.add(deviceType)
+        else:
+            created += 1
 
-            # Process each device
-            with Progress() as progress:
-                task = progress.add_task(f"[green]Processing {deviceType} devices...", total=device_count)
+    # A model that failed is retried next run, and by the shards in this one
+    for deviceType in complete - failed:
+        state.set_meta(f"model_watermark:{deviceType}", started)
+    state.close()
+    logger.info(f"Created {created} Snipe-IT models for {len(models)} models in use")
+    return created
 
-                for device_index, sn in enumerate(devices, 1):
-                    try:
-                        if sn['serial_number'] is None:
-                            logger.warning(f"{deviceType} device at index {device_index} has no serial number, skipping")
-                            progress.advance(task)
-                            continue
 
-                        # Look up existing asset
-                        asset = snipe.listHardware(sn['serial_number']).json()
-
-                        # Look up or create model
-                        model = snipe.searchModel(sn['device_model']).json()
-                        if model['total'] == 0:
-                            logger.info(f"Creating new model: {sn['device_model']}")
-                            if sn['os'] == "mac":
-                                model = snipe.createModel(sn['device_model']).json()['payload']['id']
-                            elif sn['os'] == "ios":
-                                model = snipe.createMobileModel(sn['device_model']).json()['payload']['id']
-                            elif sn['os'] == "tvos":
-                                model = snipe.createAppleTvModel(sn['device_model']).json()['payload']['id']
-                        else:
-                            model = model['rows'][0]['id']
-
-                        # Check for assigned user
-                        mosyle_user = sn.get('useremail') if sn.get('CurrentConsoleManagedUser') and 'useremail' in sn else None
-                        devicePayload = snipe.buildPayloadFromMosyle(sn)
-
-                        # Create asset if doesn't exist
-                        if asset.get('total', 0) == 0:
-                            logger.info(f"Creating new asset: {sn['serial_number']} ({sn['device_model']})")
-                            asset = snipe.createAsset(model, devicePayload)
-                            if mosyle_user:
-                                logger.info(f"Assigning asset to user: {mosyle_user}")
-                                snipe.assignAsset(mosyle_user, asset['payload']['id'])
-                            total_devices_processed += 1
-                            progress.advance(task)
-                            continue
+def plan_run(config, plan_path):
+    """
+    Compute the change set a full sync would make and save it as a plan, without writing anything.
 
-                        # Update existing asset
-                        if asset.get('total') == 1 and asset.get('rows'):
-                            logger.info(f"Updating asset: {sn['serial_number']}")
-                            snipe.updateAsset(asset['rows'][0]['id'], devicePayload, model)
-
-                        # Sync user assignment
-                        if mosyle_user:
-                            assigned = asset['rows'][0]['assigned_to']
-                            if assigned is None and sn.get('useremail'):
-                                logger.info(f"Assigning asset to user: {sn['useremail']}")
-                                snipe.assignAsset(sn['useremail'], asset['rows'][0]['id'])
-                            elif sn.get('useremail') is None:
-                                logger.info(f"Unassigning asset: {asset['rows'][0]['id']}")
-                                snipe.unasigneAsset(asset['rows'][0]['id'])
-                            elif assigned and assigned['username'] != sn['useremail']:
-                                logger.info(f"Reassigning asset from {assigned['username']} to {sn['useremail']}")
-                                snipe.unasigneAsset(asset['rows'][0]['id'])
-                                snipe.assignAsset(sn['useremail'], asset['rows'][0]['id'])
-
-                        # Sync asset tag back to Mosyle
-                        asset_tag = asset['rows'][0].get('asset_tag') if asset.get('rows') else None
-                        if not sn.get('asset_tag') or sn['asset_tag'] != asset_tag:
-                            if asset_tag:
-                                logger.info(f"Syncing asset tag to Mosyle: {sn['serial_number']} -> {asset_tag}")
-                                mosyle.setAssetTag(sn['serial_number'], asset_tag)
-
-                        total_devices_processed += 1
-                        progress.advance(task)
-
-                    except Exception as e:
-                        logger.error(f"Error processing device {sn.get('serial_number', 'unknown')}: {e}")
-                        progress.advance(task)
-                        continue
-
-            logger.info(f"Finished {deviceType}: {total_devices_processed} total devices processed")
+    Every device is fetched from Mosyle and compared against the Snipe-IT indexes; the model
+    creations, asset creations and updates, checkouts/checkins and asset tag write-backs it
+    needs are saved to `plan_path` with an estimate of the requests and runtime to apply them.
 
-        except Exception as e:
-            logger.error(f"Error processing device type {deviceType}: {e}")
+    Returns:
+        ChangePlan: The computed plan
+    """
+    logger = get_logger()
+    logger.info("=== Computing change plan ===")
+
+    mosyle, snipe = connect_clients(config)
+
+    deviceTypes = [deviceType.strip() for deviceType in config['mosyle']['deviceTypes']]
+    columns = sync_columns(config)
+    extra_columns = [column for column in (columns or []) if column not in RECORD_COLUMNS]
+    pages = mosyle.iterPagesByType(
+        {deviceType: (None, None) for deviceType in deviceTypes},
+        prefetch=MOSYLE_PREFETCH_PAGES,
+        page_workers=config['mosyle']['page_workers'],
+        specific_columns=columns,
+        make_record=lambda device: DeviceRecord.from_mosyle(device, extra_columns)
+    )
+
+    # The last record for a serial wins, as it would when syncing
+    device_actions = {}
+    incomplete = []
+    for deviceType, page, devices, total, error in pages:
+        if page is None:
+            if error is not None:
+                logger.error(f"Failed to fetch {deviceType} devices from Mosyle: {error}")
+                incomplete.append(deviceType)
             continue
+        for sn in devices:
+            if sn.get('serial_number') is None:
+                continue
+            device_actions[snipe.normalizeSerial(sn['serial_number'])] = plan_device(snipe, sn)
 
-    logger.info(f"=== Synchronization run complete. Total devices processed: {total_devices_processed} ===")
-    return total_devices_processed
+    plan = ChangePlan(snipe_url=config['snipe']['url'])
+    for actions in device_actions.values():
+        plan.add(actions)
+    plan.save(
+        plan_path,
+        rate_limit=config['snipe']['rate_limit'],
+        tag_batch_size=config['mosyle']['tag_batch_size'],
+        bulk_tags=config['mosyle']['bulk_tag_update']
+    )
+
+    counts = plan.counts()
+    estimate = plan.estimate(
+        config['snipe']['rate_limit'], config['mosyle']['tag_batch_size'], config['mosyle']['bulk_tag_update']
+    )
+    logger.info(
+        f"Plan for {plan.devices} devices: {counts['create_model']} models to create, "
+        f"{counts['create_asset']} assets to create, {counts['update_asset']} to update, "
+        f"{counts['checkout']} checkouts, {counts['checkin']} checkins, {counts['set_tag']} asset tags"
+    )
+    logger.info(
+        f"Estimated {estimate['snipe_requests']} Snipe-IT and {estimate['mosyle_requests']} Mosyle requests, "
+        f"about {estimate['seconds']:.0f}s at {config['snipe']['rate_limit']} requests/minute"
+    )
+    if incomplete:
+        logger.warning(f"Plan is incomplete, Mosyle fetch failed for: {', '.join(incomplete)}")
+    logger.info(f"=== Plan written to {plan_path} ===")
+    return plan
+
+
+def apply_run(config, plan_path, workers=1):
+    """
+    Execute a plan saved by plan_run(): models, then assets, then assignments, then asset tags.
+
+    The sync state is left alone, so the next regular run compares every device again.
+
+    Returns:
+        int: Number of actions applied
+    """
+    logger = get_logger()
+    plan = ChangePlan.load(plan_path)
+    logger.info(f"=== Applying plan {plan_path} generated {plan.generated} ===")
+    if plan.snipe_url and plan.snipe_url != config['snipe']['url']:
+        raise ValueError(f"Plan was computed against {plan.snipe_url}, not {config['snipe']['url']}")
+
+    mosyle, snipe = connect_clients(config, workers)
+    tag_queue = AssetTagQueue(
+        mosyle,
+        batch_size=config['mosyle']['tag_batch_size'],
+        bulk=config['mosyle']['bulk_tag_update']
+    )
+    outcome = apply_plan(snipe, tag_queue, plan, workers)
+    tag_summary = tag_queue.flush()
+    tag_queue.close()
+
+    logger.info(
+        f"Asset tags written to Mosyle: {tag_summary['synced']} synced, {tag_summary['failed']} failed, "
+        f"{tag_summary['deduplicated']} duplicates dropped"
+    )
+    logger.info(f"=== Plan applied: {outcome['applied']} actions applied, {outcome['failed']} failed ===")
+    return outcome['applied']
+
+
+def start_cassette(config, args):
+    """
+    Open the --record or --replay cassette and line the sync state up with it.
+
+    A recording keeps a copy of the state store it started from, and a replay starts from that
+    copy in a scratch location, so both runs skip the same devices and make the same requests.
+    The user directory is always fetched rather than read from its disk cache, so the cassette
+    holds it.
+    """
+    logger = get_logger()
+    config['cache']['user_cache_ttl'] = 0
+    if args.record:
+        cassette = use_cassette(args.record, "record")
+        cassette.save_state(config['cache']['state_db'])
+        logger.info(f"Recording Mosyle and Snipe-IT traffic to {args.record}")
+    else:
+        cassette = use_cassette(args.replay, "replay", latency_scale=args.replay_latency)
+        config['cache']['state_db'] = os.path.join(tempfile.mkdtemp(prefix="mosylesnipe-replay-"), "state.sqlite3")
+        if not cassette.restore_state(config['cache']['state_db']):
+            logger.info("Cassette has no recorded sync state, replaying from an empty state store")
+        logger.info(f"Replaying Mosyle and Snipe-IT traffic from {args.replay} at {args.replay_latency}x latency")
+    return cassette
 
 
 def main():
@@ -281,6 +1034,89 @@ def main():
         default='settings.ini',
         help='Path to settings.ini file (default: settings.ini)'
     )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=1,
+        help='Number of devices synced concurrently (default: 1)'
+    )
+    parser.add_argument(
+        '--full-every',
+        type=int,
+        default=0,
+        help='In daemon mode with calltype = timestamp, make every Nth run a full sweep (default: 0 = never)'
+    )
+    parser.add_argument(
+        '--full-resync',
+        action='store_true',
+        help='Process every device, ignoring the recorded sync state'
+    )
+    parser.add_argument(
+        '--resume',
+        action='store_true',
+        help='Continue an interrupted run from its checkpoint even if it is older than resume_window_hours'
+    )
+    parser.add_argument(
+        '--shard',
+        type=parse_shard,
+        metavar='I/N',
+        help='Sync only the devices whose serial hashes to shard I of N, with the key and rate limit from [shard-I]'
+    )
+    parser.add_argument(
+        '--shards',
+        type=int,
+        default=0,
+        metavar='N',
+        help='Run each sync as N --shard processes on this host and merge their summaries and metrics'
+    )
+    parser.add_argument('--shard-summary', help=argparse.SUPPRESS)
+    parser.add_argument('--calltype', choices=['all', 'timestamp'], help=argparse.SUPPRESS)
+    parser.add_argument(
+        '--plan',
+        metavar='FILE',
+        help='Compute the changes a full sync would make, save them to FILE as JSON and exit without writing'
+    )
+    parser.add_argument(
+        '--apply',
+        metavar='FILE',
+        help='Execute a plan saved by --plan and exit'
+    )
+    parser.add_argument(
+        '--profile',
+        nargs='?',
+        const='profile',
+        metavar='DIR',
+        help='Run one sync under cProfile and tracemalloc and write a pstats file and report to DIR (default: profile)'
+    )
+    parser.add_argument(
+        '--profile-top',
+        type=int,
+        default=30,
+        help='Number of functions and allocation sites listed in the profile report (default: 30)'
+    )
+    parser.add_argument(
+        '--record',
+        metavar='DIR',
+        help='Record every Mosyle and Snipe-IT request and response to a cassette in DIR, with secrets scrubbed; '
+             'with --shards, each shard records to DIR/shard-N'
+    )
+    parser.add_argument(
+        '--replay',
+        metavar='DIR',
+        help='Answer Mosyle and Snipe-IT requests from the cassette in DIR instead of the network; '
+             'with --shards, each shard replays DIR/shard-N'
+    )
+    parser.add_argument(
+        '--replay-latency',
+        type=float,
+        default=1.0,
+        help='With --replay, wait this multiple of each recorded latency (default: 1.0, 0 = no waiting)'
+    )
+    parser.add_argument(
+        '--show-columns',
+        action='store_true',
+        help='Print the Mosyle columns the sync requests and exit'
+    )
     parser.add_argument(
         '--log-level',
         default='INFO',
@@ -308,15 +1144,71 @@ def main():
         # Load configuration
         config = load_configuration(args.config)
 
+        if args.show_columns:
+            columns = sync_columns(config)
+            print("\n".join(columns) if columns else "Column projection is disabled; all columns are requested")
+            return
+
+        # A shard records and replays its own state store
+        if args.shard:
+            config = shard_config(config, *args.shard)
+
+        if args.record or args.replay:
+            start_cassette(config, args)
+        if args.shard_summary:
+            # Started by --shards: the launcher merges and exports the metrics
+            config['metrics']['textfile'] = ''
+            report_to_launcher(
+                lambda: run_and_export(
+                    config, full_resync=args.full_resync, calltype=args.calltype, workers=args.workers,
+                    resume=args.resume, shard=args.shard
+                ),
+                args.shard_summary
+            )
+            return
+
+        if args.shards:
+            def run(full_resync=False, calltype=None, **kwargs):
+                # One process creates new models first, so the shards don't race to create them
+                create_missing_models(config, full_resync=full_resync, calltype=calltype)
+                return launch_shards(config, args, args.shards, full_resync=full_resync, calltype=calltype, **kwargs)
+        else:
+            run = lambda **kwargs: run_and_export(config, workers=args.workers, shard=args.shard, **kwargs)
+
+        if args.plan:
+            plan_run(config, args.plan)
+            return
+
+        if args.apply:
+            apply_run(config, args.apply, workers=args.workers)
+            return
+
+        if args.profile:
+            # Profiling covers a single run, even with --daemon
+            profile_run(
+                lambda: run(full_resync=args.full_resync, resume=args.resume),
+                args.profile,
+                top=args.profile_top
+            )
+            return
+
         if args.daemon:
             # Daemon mode: run continuously
             logger.info("Entering daemon mode")
+            if config['metrics']['http_port']:
+                get_metrics().serve(config['metrics']['http_port'])
             run_count = 0
             while True:
                 try:
                     run_count += 1
                     logger.info(f"--- Run {run_count} ---")
-                    run_sync(config)
+                    # A requested full resync or resume applies to the first run only
+                    full_sweep = args.full_every > 0 and run_count % args.full_every == 0
+                    run(
+                        full_resync=args.full_resync and run_count == 1,
+                        calltype="all" if full_sweep else None,
+                        resume=args.resume and run_count == 1
+                    )
                     logger.info(f"Sleeping for {args.interval} seconds")
                     time.sleep(args.interval)
                 except KeyboardInterrupt:
@@ -328,12 +1220,15 @@ def main():
                     time.sleep(args.interval)
         else:
             # One-time mode: run once and exit
-            run_sync(config)
+            run(full_resync=args.full_resync, resume=args.resume)
             logger.info("Exiting")
 
     except Exception as e:
         logger.error(f"Fatal error: {e}")
         sys.exit(1)
+    finally:
+        if get_cassette() is not None:
+            get_cassette().close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,234 @@
+"""
+Run metrics in the Prometheus text exposition format.
+
+Request counts and latencies, retries, rate limiter sleeps and phase durations are collected
+in-process, written as a textfile for node_exporter's textfile collector at the end of each
+run, and optionally served on /metrics in daemon mode. There is no client library dependency;
+the format is simple enough to render here.
+"""
+import re
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from cache import atomic_write
+from logger_config import get_logger
+
+
+PREFIX = "mosylesnipe"
+
+# Upper bounds in seconds; Snipe-IT calls are usually sub-second, Mosyle pages take several
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# name -> (type, help)
+DEFINITIONS = {
+    "requests_total": ("counter", "API requests sent, by service, method, endpoint and response status"),
+    "request_duration_seconds": ("histogram", "API request latency, by service, method and endpoint"),
+    "retries_total": ("counter", "API requests retried, by service and reason"),
+    "request_failures_total": ("counter", "API requests abandoned after every retry failed"),
+    "rate_limiter_sleep_seconds_total": ("counter", "Seconds callers waited on the client-side rate limiter"),
+    "concurrency_wait_seconds_total": ("counter", "Seconds callers waited for a free slot under the adaptive concurrency limit"),
+    "rate_limit_per_minute": ("gauge", "Requests per minute the client currently allows itself, by service"),
+    "concurrency_limit": ("gauge", "Requests the client currently allows in flight, by service"),
+    "limit_adjustments_total": ("counter", "Adaptive limit changes, by service, direction and reason"),
+    "phase_seconds_total": ("counter", "Seconds spent in each sync phase, summed across worker threads"),
+    "device_seconds_total": ("counter", "Seconds spent syncing devices, by device type, summed across worker threads"),
+    "device_type_duration_seconds": ("gauge", "Wall time from the first page of a device type to its last device synced, in the last run"),
+    "devices_total": ("counter", "Devices handled by sync runs, by device type and outcome"),
+    "asset_updates_total": ("counter", "Existing assets compared with Mosyle, by update result"),
+    "asset_tags_total": ("counter", "Asset tag write-backs to Mosyle, by result"),
+    "run_duration_seconds": ("gauge", "Wall time of the last sync run"),
+    "last_run_timestamp_seconds": ("gauge", "Unix time the last sync run finished"),
+    "last_run_success": ("gauge", "1 if the last sync run completed, 0 if it failed"),
+}
+
+# How merge() combines a gauge reported by several shards; the rest take the largest value
+GAUGE_MERGE = {
+    "last_run_success": min,
+}
+
+_ID_SEGMENT = re.compile(r"/\d+(?=/|$)")
+
+
+def endpoint_label(url):
+    """Collapse a request path to its route, e.g. /hardware/42/checkout -> /hardware/:id/checkout."""
+    return _ID_SEGMENT.sub("/:id", url.split("?", 1)[0])
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _number(value):
+    return str(value) if isinstance(value, int) else repr(float(value))
+
+
+def _labels(labels, extra=None):
+    items = list(labels) + ([extra] if extra else [])
+    if not items:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in items) + "}"
+
+
+class Metrics:
+    """Thread-safe counters, gauges and histograms keyed by metric name and label set."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = {}
+        self._histograms = {}
+
+    @staticmethod
+    def _key(name, labels):
+        if name not in DEFINITIONS:
+            raise KeyError(f"Unknown metric {name}")
+        return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._values[key] = value
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                # One count per bucket, then sum and total count
+                histogram = self._histograms[key] = [0] * len(LATENCY_BUCKETS) + [0.0, 0]
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if value <= bound:
+                    histogram[i] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    def observe_request(self, service, method, url, seconds, status):
+        """Record one API request; `status` is the HTTP status code, or "error" if none came back."""
+        endpoint = endpoint_label(url)
+        self.inc("requests_total", service=service, method=method, endpoint=endpoint, status=status)
+        self.observe("request_duration_seconds", seconds, service=service, method=method, endpoint=endpoint)
+
+    @contextmanager
+    def phase(self, name, **labels):
+        """Time a block of sync work towards a phase (fetch, model_resolve, asset_upsert, ...)."""
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.inc("phase_seconds_total", time.monotonic() - started, phase=name, **labels)
+
+    def get(self, name, **labels):
+        with self._lock:
+            return self._values.get(self._key(name, labels), 0)
+
+    def series(self, name):
+        """Every value of a counter or gauge, keyed by its labels as a tuple of (name, value) pairs."""
+        self._key(name, {})
+        with self._lock:
+            return {labels: value for (metric, labels), value in self._values.items() if metric == name}
+
+    def snapshot(self):
+        """Every value as JSON-serialisable data, for merge() in another process."""
+        with self._lock:
+            return {
+                "values": [[name, list(labels), value] for (name, labels), value in self._values.items()],
+                "histograms": [[name, list(labels), list(h)] for (name, labels), h in self._histograms.items()],
+            }
+
+    def merge(self, snapshot, combine_gauges=True):
+        """
+        Fold in a snapshot() taken in another process, e.g. one shard of a sharded run.
+
+        Counters and histograms add up. Gauges are combined with GAUGE_MERGE, or the
+        largest value: the slowest shard's run duration, the latest finish time. With
+        combine_gauges=False the snapshot's gauges replace the current ones instead.
+        """
+        with self._lock:
+            for name, labels, value in snapshot["values"]:
+                key = (name, tuple(tuple(label) for label in labels))
+                if key not in self._values or (not combine_gauges and DEFINITIONS[name][0] == "gauge"):
+                    self._values[key] = value
+                elif DEFINITIONS[name][0] == "gauge":
+                    self._values[key] = GAUGE_MERGE.get(name, max)(self._values[key], value)
+                else:
+                    self._values[key] += value
+            for name, labels, histogram in snapshot["histograms"]:
+                key = (name, tuple(tuple(label) for label in labels))
+                current = self._histograms.get(key)
+                self._histograms[key] = histogram if current is None else [a + b for a, b in zip(current, histogram)]
+
+    def render(self):
+        """The current values in the Prometheus text exposition format."""
+        with self._lock:
+            values = dict(self._values)
+            histograms = {key: list(value) for key, value in self._histograms.items()}
+
+        lines = []
+        for name, (kind, description) in DEFINITIONS.items():
+            full_name = f"{PREFIX}_{name}"
+            if kind == "histogram":
+                series = sorted((labels, h) for (metric, labels), h in histograms.items() if metric == name)
+            else:
+                series = sorted((labels, v) for (metric, labels), v in values.items() if metric == name)
+            if not series:
+                continue
+            lines.append(f"# HELP {full_name} {description}")
+            lines.append(f"# TYPE {full_name} {kind}")
+            for labels, value in series:
+                if kind != "histogram":
+                    lines.append(f"{full_name}{_labels(labels)} {_number(value)}")
+                    continue
+                for bound, count in zip(LATENCY_BUCKETS, value):
+                    lines.append(f"{full_name}_bucket{_labels(labels, ('le', f'{bound:g}'))} {count}")
+                lines.append(f"{full_name}_bucket{_labels(labels, ('le', '+Inf'))} {value[-1]}")
+                lines.append(f"{full_name}_sum{_labels(labels)} {_number(value[-2])}")
+                lines.append(f"{full_name}_count{_labels(labels)} {value[-1]}")
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, path):
+        """Write the metrics for node_exporter's textfile collector; the rename keeps scrapes consistent."""
+        atomic_write(path, self.render().encode("utf8"))
+
+    def serve(self, port, host=""):
+        """Serve /metrics on a background thread and return the server."""
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?", 1)[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode("utf8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                get_logger().debug(f"metrics endpoint: {format % args}")
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        thread = threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True)
+        thread.start()
+        get_logger().info(f"Serving metrics on http://{host or '0.0.0.0'}:{server.server_address[1]}/metrics")
+        return server
+
+
+_metrics = None
+_metrics_lock = threading.Lock()
+
+
+def get_metrics():
+    """The process-wide Metrics registry, shared by the API clients and the sync loop."""
+    global _metrics
+    with _metrics_lock:
+        if _metrics is None:
+            _metrics = Metrics()
+        return _metrics
@@ -1,12 +1,41 @@
+import math
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
 
+from metrics import get_metrics
+from cassette import transport_adapter
+from logger_config import get_logger, LogPayload
+
+
+logger = get_logger()
+
+
+class MosyleError(Exception):
+    """A Mosyle API call returned a non-OK status."""
+
+    def __init__(self, message, page=None):
+        super().__init__(message)
+        self.page = page
+
+
 class Mosyle:
-    def __init__(self, access_token, email, password, url="https://managerapi.mosyle.com/v2"):
+    def __init__(self, access_token, email, password, url="https://managerapi.mosyle.com/v2", max_concurrency=2):
         self.url = url
         self.access_token = access_token
         self.email = email
         self.password = password
         self.session = requests.Session()
+        # Plain keep-alive transport, or the --record/--replay cassette's
+        adapter = transport_adapter("mosyle", url)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        # Caps concurrent requests across every fetch thread sharing this session
+        self._slots = threading.BoundedSemaphore(max_concurrency)
         self.jwt_token = self.login()
 
         if self.jwt_token:
@@ -23,29 +52,38 @@ class Mosyle:
             "email": self.email,
             "password": self.password
         }
+        started = time.monotonic()
         response = self.session.post(f"{self.url}/login", json=payload)
+        get_metrics().observe_request("mosyle", "POST", "/login", time.monotonic() - started, response.status_code)
 
         if response.status_code == 200:
             auth_header = response.headers.get("Authorization", "")
             if auth_header.startswith("Bearer "):
                 return auth_header.replace("Bearer ", "")
             else:
-                print("Authorization header missing or malformed.")
+                logger.error("Mosyle login response has a missing or malformed Authorization header")
         else:
-            print(f"Login failed. Status Code: {response.status_code}")
-            print(f"Error: {response.text}")
+            logger.error("Mosyle login failed with status %d: %s", response.status_code, LogPayload(response.text))
         return None
 
     def _post(self, endpoint, data):
         data["accessToken"] = self.access_token
-        response = self.session.post(f"{self.url}/{endpoint}", json=data)
+        metrics = get_metrics()
+        with self._slots:
+            started = time.monotonic()
+            try:
+                response = self.session.post(f"{self.url}/{endpoint}", json=data)
+            except requests.RequestException:
+                metrics.observe_request("mosyle", "POST", f"/{endpoint}", time.monotonic() - started, "error")
+                raise
+        metrics.observe_request("mosyle", "POST", f"/{endpoint}", time.monotonic() - started, response.status_code)
         try:
             return response.json()
         except Exception:
             return {"error": "Invalid JSON response", "text": response.text}
 
     def list(self, os, specific_columns=None, page=1):
-        print("Listing devices for OS:", os, "Page:", page)
+        logger.debug("Listing %s devices, page %d", os, page)
         data = {
 			"accessToken": self.access_token,
 			"operation": "list",
@@ -55,11 +93,292 @@ class Mosyle:
 			}
 		}
         if specific_columns:
-            data["specific_columns"] = specific_columns
+            data["options"]["specific_columns"] = specific_columns
+        return self._post("listdevices", data)
+    def listTimestamp(self, start, end, os, specific_columns=None, page=1):
+        """
+        List devices whose Mosyle record changed between two Unix timestamps.
+
+        Takes the same options as list(), plus the start/end window.
+        """
+        logger.debug("Listing %s devices changed between %d and %d, page %d", os, start, end, page)
+        data = {
+			"accessToken": self.access_token,
+			"operation": "list",
+			"options": {
+				"os": os,
+				"page": page,
+				"start": int(start),
+				"end": int(end)
+			}
+		}
+        if specific_columns:
+            data["options"]["specific_columns"] = specific_columns
         return self._post("listdevices", data)
+
     def setAssetTag(self, serialnumber, tag):
         return self._post("devices", {
 			"operation": "update_device",
 			"serialnumber": serialnumber,
 			"asset_tag": tag
 		})
+
+    def setAssetTags(self, tags):
+        """
+        Set asset tags on several devices in one update_device call.
+
+        :param tags: Dict of serial number -> asset tag
+        """
+        return self._post("devices", {
+			"operation": "update_device",
+			"elements": [
+				{"serialnumber": serialnumber, "asset_tag": tag}
+				for serialnumber, tag in tags.items()
+			]
+		})
+
+    def _fetchPages(self, os, start, end, specific_columns, page_workers, emit, make_record=None, first_page=1):
+        """
+        Fetch every page for one OS in order, handing (page, devices, total) to emit().
+
+        Once the first page reveals the row count, up to `page_workers` later pages are
+        requested at a time. Stops early if emit() returns False. A resumed run starts at
+        `first_page` and treats the pages before it as already fetched.
+        """
+        def fetch(page):
+            with get_metrics().phase("fetch", device_type=os):
+                if start is not None:
+                    response = self.listTimestamp(start, end, os, specific_columns=specific_columns, page=page)
+                else:
+                    response = self.list(os, specific_columns=specific_columns, page=page)
+            if response.get('status') != "OK":
+                raise MosyleError(response.get('message') or response.get('error') or "Unknown error", page)
+            body = response.get('response', {})
+            total = body.get('rows') if isinstance(body.get('rows'), int) else None
+            devices = body.get('devices', [])
+            if specific_columns:
+                # Projected rows may leave out empty attributes; give every requested column a value
+                for device in devices:
+                    for column in specific_columns:
+                        device.setdefault(column, None)
+            if make_record is not None:
+                devices = [make_record(device) for device in devices]
+            return devices, total
+
+        devices, total = fetch(first_page)
+        if not devices or not emit((first_page, devices, total)):
+            return
+        fetched = first_page * len(devices)
+        page = first_page + 1
+
+        if page_workers > 1 and total is not None and fetched < total:
+            last_page = math.ceil(total / len(devices))
+            window = deque()
+            with ThreadPoolExecutor(max_workers=page_workers, thread_name_prefix=f"mosyle-{os}") as pool:
+                while page <= last_page or window:
+                    while page <= last_page and len(window) < page_workers:
+                        window.append((page, pool.submit(fetch, page)))
+                        page += 1
+                    number, future = window.popleft()
+                    devices, _ = future.result()
+                    if not devices:
+                        # Fewer devices than reported; nothing further to fetch
+                        for _, pending in window:
+                            pending.cancel()
+                        return
+                    if not emit((number, devices, total)):
+                        for _, pending in window:
+                            pending.cancel()
+                        return
+                    fetched += len(devices)
+
+        # Serial paging, also picking up devices added since the row count was reported
+        while total is None or fetched < total:
+            devices, total = fetch(page)
+            if not devices or not emit((page, devices, total)):
+                return
+            fetched += len(devices)
+            page += 1
+
+    def iterPagesByType(self, sources, prefetch=1, page_workers=1, specific_columns=None, make_record=None,
+                        first_pages=None):
+        """
+        Fetch several device types concurrently, yielding pages as they arrive.
+
+        Each type is fetched on its own thread over the shared JWT session; the number of
+        requests in flight is capped by the max_concurrency given to the constructor. At most
+        `prefetch` pages per type wait in memory for the consumer.
+
+        :param sources: Dict of os type -> (start, end) change window, or (None, None) for all devices
+        :param prefetch: Pages per type fetched ahead of the consumer
+        :param page_workers: Pages of one type fetched in parallel once the row count is known
+        :param specific_columns: Columns to request instead of every attribute
+        :param make_record: Optional callable turning each raw device dict into a record as the page is parsed
+        :param first_pages: Optional dict of os type -> page to start from, for resuming a run
+        :return: Generator of (os, page, devices, total, error). A type is finished when it yields
+                 page None; error is then set to the exception if its fetch failed.
+        """
+        pages = queue.Queue(maxsize=max(1, prefetch * len(sources)))
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    pages.put(item, timeout=0.5)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def fetch(os, start, end):
+            error = None
+            try:
+                self._fetchPages(
+                    os, start, end, specific_columns, page_workers,
+                    lambda item: put((os,) + item + (None,)),
+                    make_record,
+                    (first_pages or {}).get(os, 1)
+                )
+            except Exception as e:
+                error = e
+            put((os, None, None, None, error))
+
+        threads = [
+            threading.Thread(target=fetch, args=(os, start, end), name=f"mosyle-{os}-pages", daemon=True)
+            for os, (start, end) in sources.items()
+        ]
+        for thread in threads:
+            thread.start()
+        try:
+            remaining = len(threads)
+            while remaining:
+                item = pages.get()
+                if item[1] is None:
+                    remaining -= 1
+                yield item
+        finally:
+            stop.set()
+
+
+class AssetTagQueue:
+    """
+    Collects asset tag write-backs and sends them to Mosyle off the sync threads.
+
+    Tags are deduplicated per serial (the latest tag wins) and sent in batches once
+    `batch_size` are pending, then whatever is left on flush(). With `bulk`, a batch goes out
+    as one multi-device update_device call; otherwise each tag is sent on a small pool.
+    Failed calls are retried with backoff.
+    """
+
+    def __init__(self, mosyle, batch_size=50, bulk=False, workers=4, max_retries=3, retry_delay=2):
+        self.mosyle = mosyle
+        self.batch_size = batch_size
+        self.bulk = bulk
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.pending = {}
+        # Every tag not yet confirmed by Mosyle, queued, in flight or failed; checkpoints save these
+        self.unsent = {}
+        self.synced = 0
+        self.failed = 0
+        self.deduplicated = 0
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="mosyle-tags")
+        self._futures = []
+
+    def enqueue(self, serialnumber, tag):
+        """Queue a tag for a device, replacing any tag still pending for it."""
+        with self._lock:
+            if serialnumber in self.pending:
+                self.deduplicated += 1
+            self.pending[serialnumber] = tag
+            self.unsent[serialnumber] = tag
+            if len(self.pending) < self.batch_size:
+                return
+            batch, self.pending = self.pending, {}
+        self._submit(batch)
+
+    def _submit(self, batch):
+        if self.bulk:
+            futures = [self._pool.submit(self._sendBatch, batch)]
+        else:
+            futures = [self._pool.submit(self._sendOne, serial, tag) for serial, tag in batch.items()]
+        with self._lock:
+            self._futures.extend(futures)
+
+    def _call(self, send, description):
+        metrics = get_metrics()
+        with metrics.phase("tag_sync"):
+            for attempt in range(self.max_retries):
+                try:
+                    response = send()
+                    if response.get('status') == "OK":
+                        return True
+                    logger.warning("Mosyle rejected %s: %s", description, LogPayload(response.get('message') or response))
+                    reason = "rejected"
+                except requests.RequestException as e:
+                    logger.warning("Mosyle request for %s failed: %s", description, e)
+                    reason = "connection_error"
+                if attempt + 1 < self.max_retries:
+                    metrics.inc("retries_total", service="mosyle", reason=reason)
+                    time.sleep(self.retry_delay * 2 ** attempt)
+            metrics.inc("request_failures_total", service="mosyle")
+            return False
+
+    def _sendOne(self, serialnumber, tag):
+        ok = self._call(lambda: self.mosyle.setAssetTag(serialnumber, tag), f"asset tag {tag} for {serialnumber}")
+        with self._lock:
+            if ok:
+                self.synced += 1
+                self._sent(serialnumber, tag)
+            else:
+                self.failed += 1
+
+    def _sendBatch(self, batch):
+        if self._call(lambda: self.mosyle.setAssetTags(batch), f"batch of {len(batch)} asset tags"):
+            with self._lock:
+                self.synced += len(batch)
+                for serial, tag in batch.items():
+                    self._sent(serial, tag)
+            return
+        # The batch as a whole failed; one bad serial shouldn't cost the others their tags
+        for serial, tag in batch.items():
+            self._sendOne(serial, tag)
+
+    def _sent(self, serialnumber, tag):
+        # A newer tag queued for the serial meanwhile is still unsent
+        if self.unsent.get(serialnumber) == tag:
+            del self.unsent[serialnumber]
+
+    def outstanding(self):
+        """Tags queued but not yet confirmed by Mosyle, as a dict of serial -> tag."""
+        with self._lock:
+            return dict(self.unsent)
+
+    def flush(self):
+        """Send everything still pending and wait for all write-backs to finish."""
+        with self._lock:
+            batch, self.pending = self.pending, {}
+        if batch:
+            self._submit(batch)
+        while True:
+            with self._lock:
+                futures, self._futures = self._futures, []
+            if not futures:
+                break
+            for future in futures:
+                future.result()
+        return self.summary()
+
+    def close(self):
+        self.flush()
+        self._pool.shutdown()
+
+    def summary(self):
+        with self._lock:
+            return {
+                "synced": self.synced,
+                "failed": self.failed,
+                "deduplicated": self.deduplicated,
+                "pending": len(self.pending)
+            }
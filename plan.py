@@ -0,0 +1,322 @@
+"""
+Change plans: the writes a sync would make, worked out without making them.
+
+plan_device() turns one Mosyle record into a list of actions against the loaded Snipe-IT
+indexes. A normal run applies each device's actions straight away; --plan collects them
+into a ChangePlan file that --apply executes later.
+"""
+import datetime
+import json
+import math
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from cache import atomic_write
+from logger_config import get_logger
+from metrics import get_metrics
+
+
+PLAN_VERSION = 1
+
+# Plan sections in the order they are applied: models must exist before assets use them,
+# assets before they are checked out, and tags are only known once assets exist
+PHASES = ("models", "assets", "assignments", "tags")
+
+PHASE_OF = {
+    "create_model": "models",
+    "create_asset": "assets",
+    "update_asset": "assets",
+    "checkin": "assignments",
+    "checkout": "assignments",
+    "set_tag": "tags",
+}
+
+# Sync phase each action's time is reported under
+METRIC_PHASES = {
+    "create_model": "model_resolve",
+    "create_asset": "asset_upsert",
+    "update_asset": "asset_upsert",
+    "checkin": "assignment",
+    "checkout": "assignment",
+    "set_tag": "tag_sync",
+}
+
+MODEL_OS = ("mac", "ios", "tvos")
+
+
+class ActionError(Exception):
+    """A plan action that Snipe-IT refused or that could not be carried out."""
+
+
+def plan_device(snipe, sn, update_stats=None):
+    """
+    Work out what syncing one Mosyle device would change in Snipe-IT and Mosyle.
+
+    Nothing is written; only the indexes loaded on `snipe` are read.
+
+    Args:
+        snipe: Snipe client with its hardware, model and user indexes loaded
+        sn: Device record from Mosyle
+        update_stats: Optional Counter that receives the skipped/partial/full asset update result
+
+    Returns:
+        list: Action dicts in the order they must run, or None if the device can't be synced
+    """
+    logger = get_logger()
+    serial = sn['serial_number']
+    actions = []
+
+    model_row = snipe.findModel(sn['device_model'])
+    if model_row is None:
+        if sn.get('os') not in MODEL_OS:
+            logger.warning("Could not resolve model %s for %s, skipping", sn['device_model'], serial)
+            return None
+        actions.append({"action": "create_model", "model": sn['device_model'], "os": sn['os']})
+    model_id = model_row.get('id') if model_row else None
+
+    mosyle_user = sn.get('useremail') if sn.get('CurrentConsoleManagedUser') and 'useremail' in sn else None
+    payload = snipe.buildPayloadFromMosyle(sn)
+
+    asset = snipe.findHardware(serial)
+    if asset is None:
+        actions.append({
+            "action": "create_asset", "serial": serial,
+            "model": sn['device_model'], "os": sn['os'], "payload": payload
+        })
+        if mosyle_user:
+            actions.append({"action": "checkout", "serial": serial, "asset_id": None, "user": mosyle_user})
+        return actions
+
+    # Only fields that differ from Snipe-IT are sent; a model that doesn't exist yet is set once created
+    changes = snipe.diffAssetPayload(asset, payload, model_id)
+    model_pending = model_id is None
+    if changes or model_pending:
+        compared = len(payload) - ('serial' in payload) + 1
+        kind = "full" if len(changes) + model_pending == compared else "partial"
+        actions.append({
+            "action": "update_asset", "serial": serial, "asset_id": asset['id'], "changes": changes,
+            "model": sn['device_model'], "os": sn['os'], "model_pending": model_pending, "kind": kind
+        })
+    else:
+        kind = "skipped"
+    if update_stats is not None:
+        update_stats[kind] += 1
+
+    if mosyle_user:
+        assigned = asset.get('assigned_to')
+        if assigned is None and sn.get('useremail'):
+            actions.append({"action": "checkout", "serial": serial, "asset_id": asset['id'], "user": sn['useremail']})
+        elif sn.get('useremail') is None:
+            actions.append({"action": "checkin", "serial": serial, "asset_id": asset['id']})
+        elif assigned and assigned['username'] != sn['useremail']:
+            actions.append({"action": "checkin", "serial": serial, "asset_id": asset['id']})
+            actions.append({"action": "checkout", "serial": serial, "asset_id": asset['id'], "user": sn['useremail']})
+
+    asset_tag = asset.get('asset_tag')
+    if asset_tag and sn.get('asset_tag') != asset_tag:
+        actions.append({"action": "set_tag", "serial": serial, "asset_tag": asset_tag})
+
+    return actions
+
+
+def _check(response, what):
+    """Raise ActionError unless a Snipe-IT write response reports success."""
+    if response is None:
+        raise ActionError(f"Could not {what}: no response from Snipe-IT")
+    try:
+        result = response.json()
+    except ValueError:
+        result = {}
+    # Snipe-IT reports most refusals as HTTP 200 with an error status
+    if not response.ok or result.get('status') != 'success':
+        raise ActionError(f"Could not {what}: {result.get('messages') or f'HTTP {response.status_code}'}")
+
+
+def apply_actions(snipe, tag_queue, actions):
+    """
+    Execute actions from plan_device() in order.
+
+    Each action is checked against the current indexes first, so actions from a plan that has
+    gone stale are skipped instead of duplicating a model, asset or checkout.
+
+    Raises:
+        ActionError: If an action fails; the device's later actions are not run
+    """
+    logger = get_logger()
+    metrics = get_metrics()
+    for action in actions:
+        kind = action['action']
+        if kind not in METRIC_PHASES:
+            raise ValueError(f"Unknown plan action {kind!r}")
+        serial = action.get('serial')
+
+        with metrics.phase(METRIC_PHASES[kind]):
+            if kind == "create_model":
+                if snipe.getModelId(action['model'], action['os']) is None:
+                    raise ActionError(f"Could not resolve model {action['model']}")
+
+            elif kind == "create_asset":
+                if snipe.findHardware(serial) is not None:
+                    logger.warning("Asset %s already exists in Snipe-IT, not creating it again", serial)
+                    continue
+                model_id = snipe.getModelId(action['model'], action['os'])
+                if model_id is None:
+                    raise ActionError(f"Could not resolve model {action['model']} for {serial}")
+                logger.info("Creating new asset: %s (%s)", serial, action['model'])
+                result = snipe.createAsset(model_id, dict(action['payload']))
+                if result.get('status') != 'success':
+                    raise ActionError(f"Snipe-IT did not create asset {serial}: {result.get('messages')}")
+
+            elif kind == "update_asset":
+                if action['asset_id'] not in snipe.hardware_by_id:
+                    logger.warning("Asset %s (%s) is no longer in Snipe-IT, not updating it", action['asset_id'], serial)
+                    continue
+                changes = dict(action['changes'])
+                if action.get('model_pending'):
+                    model_id = snipe.getModelId(action['model'], action['os'])
+                    if model_id is None:
+                        raise ActionError(f"Could not resolve model {action['model']} for {serial}")
+                    changes['model_id'] = model_id
+                _check(snipe.updateAsset(action['asset_id'], changes), f"update asset {serial}")
+                logger.info("Updated asset (%s): %s", action.get('kind', 'partial'), serial)
+
+            elif kind == "checkin":
+                asset = snipe.hardware_by_id.get(action['asset_id'])
+                if asset is not None and asset.get('assigned_to') is None:
+                    logger.debug("Asset %s is already checked in", serial)
+                    continue
+                logger.info("Unassigning asset: %s", action['asset_id'])
+                _check(snipe.unasigneAsset(action['asset_id']), f"check in asset {serial}")
+
+            elif kind == "checkout":
+                asset = snipe.hardware_by_id.get(action['asset_id']) if action['asset_id'] else snipe.findHardware(serial)
+                if asset is None:
+                    logger.warning("Asset %s was not found in Snipe-IT, cannot assign it to %s", serial, action['user'])
+                    continue
+                assigned = asset.get('assigned_to') or {}
+                if assigned.get('username') == action['user']:
+                    logger.debug("Asset %s is already assigned to %s", serial, action['user'])
+                    continue
+                if snipe.findUser(action['user']) is None:
+                    logger.warning("No Snipe-IT user matches %s, not assigning asset %s", action['user'], serial)
+                    continue
+                logger.info("Assigning asset %s to user: %s", serial, action['user'])
+                _check(snipe.assignAsset(action['user'], asset['id']), f"assign asset {serial} to {action['user']}")
+
+            elif kind == "set_tag":
+                logger.debug("Queueing asset tag for Mosyle: %s -> %s", serial, action['asset_tag'])
+                tag_queue.enqueue(serial, action['asset_tag'])
+
+
+class ChangePlan:
+    """
+    Every action a sync run would take, grouped into PHASES and saved as JSON.
+
+    Model creations are deduplicated across devices, so a model shared by a hundred new
+    devices is created once.
+    """
+
+    def __init__(self, sections=None, devices=0, generated=None, snipe_url=None):
+        self.sections = {phase: list((sections or {}).get(phase, [])) for phase in PHASES}
+        self.devices = devices
+        self.generated = generated or datetime.datetime.now().isoformat(timespec="seconds")
+        self.snipe_url = snipe_url
+        self._models = {action['model'].strip().lower() for action in self.sections['models']}
+
+    def add(self, actions):
+        """Add one device's actions from plan_device()."""
+        self.devices += 1
+        for action in actions or []:
+            if action['action'] == "create_model":
+                key = action['model'].strip().lower()
+                if key in self._models:
+                    continue
+                self._models.add(key)
+            self.sections[PHASE_OF[action['action']]].append(action)
+
+    def counts(self):
+        return Counter(action['action'] for phase in PHASES for action in self.sections[phase])
+
+    def estimate(self, rate_limit, tag_batch_size=50, bulk_tags=False):
+        """
+        Estimate the requests and runtime needed to apply the plan.
+
+        Creating a model takes three Snipe-IT requests (a lookup in case another run created it,
+        the create, and a lookup to pick up the row Snipe-IT kept); every other Snipe-IT action
+        is one. Snipe-IT requests are paced at `rate_limit` per minute, which bounds the runtime.
+        Tag write-backs go to Mosyle, one call per tag or one per batch with `bulk_tags`, and are
+        not rate limited.
+        """
+        snipe_requests = 3 * len(self.sections['models']) + len(self.sections['assets']) + len(self.sections['assignments'])
+        tags = len(self.sections['tags'])
+        mosyle_requests = math.ceil(tags / max(tag_batch_size, 1)) if bulk_tags else tags
+        return {
+            "snipe_requests": snipe_requests,
+            "mosyle_requests": mosyle_requests,
+            "seconds": round(snipe_requests * 60 / rate_limit, 1) if rate_limit else 0,
+        }
+
+    def to_dict(self, rate_limit=None, tag_batch_size=50, bulk_tags=False):
+        plan = OrderedDict([
+            ("version", PLAN_VERSION),
+            ("generated", self.generated),
+            ("snipe_url", self.snipe_url),
+            ("devices", self.devices),
+            ("counts", dict(self.counts())),
+        ])
+        if rate_limit is not None:
+            plan["estimate"] = self.estimate(rate_limit, tag_batch_size, bulk_tags)
+        for phase in PHASES:
+            plan[phase] = self.sections[phase]
+        return plan
+
+    def save(self, path, **estimate_options):
+        data = json.dumps(self.to_dict(**estimate_options), indent=2, default=str)
+        atomic_write(path, data.encode("utf8"))
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "r", encoding="utf8") as f:
+            data = json.load(f)
+        if data.get("version") != PLAN_VERSION:
+            raise ValueError(f"Unsupported plan version {data.get('version')} in {path}")
+        return cls(
+            sections={phase: data.get(phase, []) for phase in PHASES},
+            devices=data.get("devices", 0),
+            generated=data.get("generated"),
+            snipe_url=data.get("snipe_url"),
+        )
+
+
+def apply_plan(snipe, tag_queue, plan, workers=1):
+    """
+    Execute a ChangePlan phase by phase.
+
+    Within a phase, actions are grouped by serial and the groups run on `workers` threads;
+    each serial's actions keep their planned order (a checkin before its checkout).
+
+    Returns:
+        Counter: Applied and failed action counts
+    """
+    logger = get_logger()
+    outcome = Counter()
+
+    def run(actions):
+        try:
+            apply_actions(snipe, tag_queue, actions)
+            return Counter(applied=len(actions))
+        except Exception as e:
+            logger.error(f"Error applying plan actions for {actions[0].get('serial') or actions[0].get('model')}: {e}")
+            return Counter(failed=len(actions))
+
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+        for phase in PHASES:
+            groups = OrderedDict()
+            for action in plan.sections[phase]:
+                groups.setdefault(action.get('serial') or action.get('model'), []).append(action)
+            if not groups:
+                continue
+            logger.info(f"Applying {len(plan.sections[phase])} {phase} actions")
+            for result in pool.map(run, groups.values()):
+                outcome.update(result)
+    return outcome
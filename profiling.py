@@ -0,0 +1,237 @@
+"""
+Profiling mode (--profile): run one sync under cProfile and tracemalloc.
+
+Writes a pstats file, which snakeviz or `python -m pstats` can open, and a text report with
+the hottest functions, peak memory with the allocation sites behind it, and a breakdown of
+time per sync phase and per device type taken from the run's metrics.
+"""
+import cProfile
+import functools
+import io
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from pathlib import Path
+
+from logger_config import get_logger
+from metrics import get_metrics
+
+
+# Frames kept per allocation; enough to see past json/requests internals to our call site
+TRACE_FRAMES = 10
+
+# How often the peak sampler checks traced memory, and how much it must grow before another snapshot
+PEAK_SAMPLE_SECONDS = 0.5
+PEAK_SNAPSHOT_GROWTH = 1.1
+
+# Allocations are attributed to the innermost frame in this repository's code
+PROJECT_ROOT = Path(__file__).resolve().parent
+
+
+class ThreadProfiler:
+    """cProfile for the calling thread and for every thread started while it is running."""
+
+    def __init__(self):
+        self.profiles = []
+        self.threads_profiled = True
+        self._lock = threading.Lock()
+
+    def _enable(self):
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Interpreters that only allow one active profiler leave worker threads unprofiled
+            self.threads_profiled = False
+            return
+        with self._lock:
+            self.profiles.append(profile)
+
+    def _start_thread(self, frame, event, arg):
+        # Runs as the first profile event of each new thread; swap in a real profiler
+        sys.setprofile(None)
+        self._enable()
+
+    def start(self):
+        self._enable()
+        threading.setprofile(self._start_thread)
+
+    def stop(self):
+        threading.setprofile(None)
+        for profile in self.profiles:
+            profile.disable()
+
+    def stats(self):
+        stats = pstats.Stats(self.profiles[0])
+        for profile in self.profiles[1:]:
+            stats.add(profile)
+        return stats
+
+
+class PeakSampler:
+    """Snapshots tracemalloc whenever traced memory reaches a new high, so the peak can be attributed."""
+
+    def __init__(self):
+        self.snapshot = None
+        self.snapshot_size = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profile-peak", daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(PEAK_SAMPLE_SECONDS):
+            self.sample()
+
+    def sample(self):
+        current, _ = tracemalloc.get_traced_memory()
+        if current > self.snapshot_size * PEAK_SNAPSHOT_GROWTH:
+            self.snapshot = tracemalloc.take_snapshot()
+            self.snapshot_size = current
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.sample()
+
+
+def _label_value(labels, name):
+    return dict(labels).get(name)
+
+
+def _delta(before, after):
+    return {labels: value - before.get(labels, 0) for labels, value in after.items()}
+
+
+def phase_report(before, wall):
+    """Phase and device type timings accumulated since `before` (a dict of metric series)."""
+    metrics = get_metrics()
+    lines = [f"Wall time: {wall:.2f}s", "", "Phases (threaded phases are summed across workers):"]
+
+    phases = {}
+    for labels, seconds in _delta(before['phase_seconds_total'], metrics.series('phase_seconds_total')).items():
+        phase = _label_value(labels, 'phase')
+        phases[phase] = phases.get(phase, 0) + seconds
+    for phase, seconds in sorted(phases.items(), key=lambda item: -item[1]):
+        lines.append(f"  {phase:<16} {seconds:10.2f}s  {seconds / wall * 100 if wall else 0:6.1f}% of wall")
+
+    lines += ["", "Device types:"]
+    devices = {}
+    for labels, count in _delta(before['devices_total'], metrics.series('devices_total')).items():
+        deviceType = _label_value(labels, 'device_type')
+        devices[deviceType] = devices.get(deviceType, 0) + count
+    fetch = {
+        _label_value(labels, 'device_type'): seconds
+        for labels, seconds in _delta(before['phase_seconds_total'], metrics.series('phase_seconds_total')).items()
+        if _label_value(labels, 'phase') == 'fetch'
+    }
+    syncing = {
+        _label_value(labels, 'device_type'): seconds
+        for labels, seconds in _delta(before['device_seconds_total'], metrics.series('device_seconds_total')).items()
+    }
+    durations = {
+        _label_value(labels, 'device_type'): seconds
+        for labels, seconds in metrics.series('device_type_duration_seconds').items()
+    }
+    for deviceType in sorted(devices):
+        lines.append(
+            f"  {deviceType:<6} {devices[deviceType]:>7} devices  wall {durations.get(deviceType, 0):8.2f}s  "
+            f"fetch {fetch.get(deviceType, 0):8.2f}s  sync {syncing.get(deviceType, 0):8.2f}s"
+        )
+    return lines
+
+
+@functools.lru_cache(maxsize=None)
+def _in_project(filename):
+    # Frozen and generated modules have pseudo-filenames like "<frozen abc>"
+    if filename.startswith("<"):
+        return False
+    path = Path(filename).resolve()
+    return path.is_relative_to(PROJECT_ROOT) and "site-packages" not in path.parts
+
+
+def _project_frame(traceback):
+    """The innermost frame of a tracemalloc traceback in our own code, or the innermost frame if none is."""
+    for frame in reversed(traceback):
+        if _in_project(frame.filename):
+            return frame
+    return traceback[-1]
+
+
+def memory_report(peak, snapshot, top):
+    lines = [f"Peak traced memory: {peak / 1024 / 1024:.1f} MB"]
+    if snapshot is None:
+        return lines
+    snapshot = snapshot.filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap*>"),
+    ])
+    lines.append(f"Allocation sites at the peak (top {top}):")
+    for stat in snapshot.statistics("traceback")[:top]:
+        # Tracebacks are oldest frame first; the allocation site is the last one
+        frame = stat.traceback[-1]
+        lines.append(f"  {stat.size / 1024:10.1f} KiB  {stat.count:8} blocks  {frame.filename}:{frame.lineno}")
+        # The innermost frame is often inside a library; show where our code called it
+        caller = _project_frame(stat.traceback)
+        if caller != frame:
+            lines.append(f"  {'':>31}  from {caller.filename}:{caller.lineno}")
+    return lines
+
+
+def profile_run(run, out_dir, top=30):
+    """
+    Call run() under cProfile and tracemalloc and write the results to `out_dir`.
+
+    Args:
+        run: Callable performing one sync run
+        out_dir: Directory for sync.pstats and profile.txt (created if doesn't exist)
+        top: Number of functions and allocation sites listed in the report
+
+    Returns:
+        Whatever run() returned
+    """
+    logger = get_logger()
+    metrics = get_metrics()
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    before = {
+        name: metrics.series(name)
+        for name in ('phase_seconds_total', 'devices_total', 'device_seconds_total')
+    }
+    tracemalloc.start(TRACE_FRAMES)
+    sampler = PeakSampler()
+    sampler.start()
+    profiler = ThreadProfiler()
+    started = time.monotonic()
+    profiler.start()
+    try:
+        return run()
+    finally:
+        profiler.stop()
+        wall = time.monotonic() - started
+        sampler.stop()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        stats = profiler.stats()
+        stats_path = out_dir / "sync.pstats"
+        stats.dump_stats(str(stats_path))
+
+        lines = phase_report(before, wall)
+        lines += [""] + memory_report(peak, sampler.snapshot, top)
+        if not profiler.threads_profiled:
+            lines += ["", "Note: only the main thread was profiled; this interpreter allows one profiler at a time"]
+        for sort in ("cumulative", "tottime"):
+            buffer = io.StringIO()
+            pstats.Stats(stats_path.as_posix(), stream=buffer).strip_dirs().sort_stats(sort).print_stats(top)
+            lines += ["", f"Top {top} functions by {sort}:", buffer.getvalue().strip()]
+
+        report = "\n".join(lines) + "\n"
+        report_path = out_dir / "profile.txt"
+        report_path.write_text(report, encoding="utf8")
+        print(report)
+        logger.info(f"Profile written to {stats_path} and {report_path}")
@@ -0,0 +1,279 @@
+"""
+Client-side rate limiting for the Snipe-IT API.
+A token bucket shared by every thread using a client, kept in step with the server's
+X-RateLimit-* and Retry-After headers, and optionally an AIMD controller that tunes the
+bucket's rate and the number of requests in flight from the responses coming back.
+"""
+import threading
+import time
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+
+from logger_config import get_logger
+from metrics import get_metrics
+
+
+def parse_retry_after(value):
+    """Parse a Retry-After header (delta-seconds or HTTP date) into seconds, or None."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    def __init__(self, rate_per_minute, burst=None):
+        """
+        Args:
+            rate_per_minute: Sustained request rate, e.g. the Snipe-IT API throttle
+            burst: Bucket capacity; defaults to a tenth of a minute's budget so requests stay smooth
+        """
+        self.rate_per_minute = rate_per_minute
+        # Lowest limit Snipe-IT has reported; set_rate() never goes above it
+        self.server_limit = None
+        self.capacity = burst or max(1, rate_per_minute // 10)
+        self.tokens = float(self.capacity)
+        self.blocked_until = 0.0
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    @property
+    def rate(self):
+        return self.rate_per_minute / 60.0
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self):
+        """
+        Take one token, sleeping until one is available.
+
+        Returns:
+            float: Seconds spent waiting
+        """
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now >= self.blocked_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                delay = max(self.blocked_until - now, (1 - self.tokens) / self.rate)
+            time.sleep(delay)
+            waited += delay
+
+    def update_from_headers(self, headers, status_code=None):
+        """
+        Reconcile the bucket with what Snipe-IT reports about the current window.
+
+        Args:
+            headers: Response headers
+            status_code: Response status; a 429 empties the bucket until Retry-After has passed
+        """
+        logger = get_logger()
+        limit = headers.get('X-RateLimit-Limit')
+        remaining = headers.get('X-RateLimit-Remaining')
+        retry_after = parse_retry_after(headers.get('Retry-After'))
+
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            if limit and limit.isdigit() and 0 < int(limit) < self.rate_per_minute:
+                logger.warning(f"Snipe-IT reports a rate limit of {limit}/min, lowering ours from {self.rate_per_minute}/min")
+                self.server_limit = int(limit)
+                self.rate_per_minute = int(limit)
+                self.capacity = max(1, self.rate_per_minute // 10)
+            if remaining is not None and remaining.isdigit():
+                self.tokens = min(self.tokens, float(remaining))
+            if status_code == 429:
+                self.tokens = 0.0
+                # Without Retry-After, wait for the bucket to earn a full burst back
+                delay = retry_after if retry_after is not None else self.capacity / self.rate
+                self.blocked_until = max(self.blocked_until, now + delay)
+                logger.warning(f"Rate limited by Snipe-IT, pausing requests for {delay:.1f} seconds")
+
+    def set_rate(self, rate_per_minute):
+        """Change the sustained rate, capped at any limit Snipe-IT has reported. Returns the rate in effect."""
+        with self._lock:
+            self._refill(time.monotonic())
+            if self.server_limit is not None:
+                rate_per_minute = min(rate_per_minute, self.server_limit)
+            self.rate_per_minute = max(1, int(rate_per_minute))
+            self.capacity = max(1, self.rate_per_minute // 10)
+            self.tokens = min(self.tokens, self.capacity)
+            return self.rate_per_minute
+
+
+class ConcurrencyGate:
+    """A semaphore whose limit can be changed while threads are waiting on it."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.active = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        """
+        Take a slot, waiting until fewer than `limit` are taken.
+
+        Returns:
+            float: Seconds spent waiting
+        """
+        started = time.monotonic()
+        with self._condition:
+            while self.active >= self.limit:
+                self._condition.wait()
+            self.active += 1
+        return time.monotonic() - started
+
+    def release(self):
+        with self._condition:
+            self.active -= 1
+            self._condition.notify()
+
+    def set_limit(self, limit):
+        with self._condition:
+            self.limit = max(1, limit)
+            self._condition.notify_all()
+
+
+class AdaptiveController:
+    """
+    AIMD control of a client's request rate and concurrency.
+
+    Every `interval` seconds in which requests had to wait on the limits, both are raised
+    a step (additive increase) as long as latency stays under the target. A 429 halves them,
+    a 5xx or connection error cuts them by a third, and latency over the target by a fifth
+    (multiplicative decrease), at most once per interval so a burst of errors from requests
+    already in flight counts once. Neither ever exceeds its configured ceiling.
+
+    Args:
+        bucket: TokenBucket whose rate is controlled; its current rate is the starting point
+        max_rate: Hard ceiling in requests per minute
+        max_concurrency: Hard ceiling on requests in flight, also the starting concurrency
+        latency_target: Smoothed request latency in seconds above which the limits back off
+        interval: Seconds between adjustments
+    """
+
+    # Multiplier applied to both limits, per congestion signal
+    BACKOFF = {"rate_limited": 0.5, "server_error": 0.67, "latency": 0.8}
+    REASONS = {"rate_limited": "rate limited", "server_error": "server error", "latency": "slow responses"}
+    # Smoothing for the latency average; about the last 10 requests dominate
+    LATENCY_WEIGHT = 0.2
+    # Seconds between log lines about raised limits; lowered limits are always logged
+    LOG_INTERVAL = 30
+
+    def __init__(self, bucket, max_rate, max_concurrency, latency_target=1.0, interval=5.0, service="snipe"):
+        self.bucket = bucket
+        self.max_rate = max_rate
+        self.min_rate = max(1, max_rate // 20)
+        self.rate_step = max(1, max_rate // 20)
+        self.max_concurrency = max(1, max_concurrency)
+        self.latency_target = latency_target
+        self.interval = interval
+        self.service = service
+        self.gate = ConcurrencyGate(self.max_concurrency)
+        self.rate = float(min(bucket.rate_per_minute, max_rate))
+        self.concurrency = float(self.max_concurrency)
+        self.latency = None
+        self._throttled = False
+        self._lock = threading.Lock()
+        self._window_started = time.monotonic()
+        self._calm_until = 0.0
+        self._logged = 0.0
+        self._apply()
+
+    @contextmanager
+    def slot(self):
+        """Hold one of the concurrency slots for the duration of a request."""
+        waited = self.gate.acquire()
+        if waited > 0.001:
+            get_metrics().inc("concurrency_wait_seconds_total", waited, service=self.service)
+            self.throttled()
+        try:
+            yield
+        finally:
+            self.gate.release()
+
+    def throttled(self):
+        """Note that a request had to wait on the rate or concurrency limit, so raising them would help."""
+        self._throttled = True
+
+    def observe(self, seconds, status):
+        """Feed back one response: its latency and HTTP status, or "error" if none came back."""
+        now = time.monotonic()
+        with self._lock:
+            if status == 429:
+                self._decrease(now, "rate_limited")
+                return
+            if status == "error" or status >= 500:
+                self._decrease(now, "server_error")
+                return
+            if self.latency is None:
+                self.latency = seconds
+            else:
+                self.latency += self.LATENCY_WEIGHT * (seconds - self.latency)
+            if now - self._window_started < self.interval:
+                return
+            if self.latency > self.latency_target:
+                self._decrease(now, "latency")
+            elif self._throttled:
+                self._increase(now)
+            self._window_started = now
+            self._throttled = False
+
+    def _ceiling(self):
+        # Snipe-IT's own reported limit, when lower, caps the configured ceiling
+        if self.bucket.server_limit is not None:
+            return min(self.max_rate, self.bucket.server_limit)
+        return self.max_rate
+
+    def _decrease(self, now, reason):
+        if now < self._calm_until:
+            return
+        factor = self.BACKOFF[reason]
+        # Start from the bucket's rate, which the server's headers may have lowered meanwhile
+        self.rate = max(self.min_rate, min(self.rate, self.bucket.rate_per_minute) * factor)
+        self.concurrency = max(1.0, self.concurrency * factor)
+        self._calm_until = now + self.interval
+        self._window_started = now
+        self._throttled = False
+        self._apply()
+        get_metrics().inc("limit_adjustments_total", service=self.service, direction="down", reason=reason)
+        get_logger().info(
+            f"Lowered {self.service} limits to {self.bucket.rate_per_minute}/min and {self.gate.limit} in flight "
+            f"({self.REASONS[reason]}, latency {self.latency or 0:.2f}s)"
+        )
+
+    def _increase(self, now):
+        ceiling = self._ceiling()
+        self.rate = min(self.rate, self.bucket.rate_per_minute)
+        if self.rate >= ceiling and self.concurrency >= self.max_concurrency:
+            return
+        self.rate = min(ceiling, self.rate + self.rate_step)
+        self.concurrency = min(self.max_concurrency, self.concurrency + 1)
+        self._apply()
+        get_metrics().inc("limit_adjustments_total", service=self.service, direction="up", reason="throttled")
+        at_ceiling = self.rate >= ceiling and self.concurrency >= self.max_concurrency
+        if now - self._logged >= self.LOG_INTERVAL or at_ceiling:
+            self._logged = now
+            get_logger().info(
+                f"Raised {self.service} limits to {self.bucket.rate_per_minute}/min and {self.gate.limit} in flight "
+                f"(latency {self.latency or 0:.2f}s, ceiling {ceiling}/min and {self.max_concurrency})"
+            )
+
+    def _apply(self):
+        # The bucket may hold the rate lower still, if Snipe-IT reported a lower limit
+        self.rate = float(self.bucket.set_rate(self.rate))
+        self.gate.set_limit(int(self.concurrency))
+        metrics = get_metrics()
+        metrics.set("rate_limit_per_minute", self.bucket.rate_per_minute, service=self.service)
+        metrics.set("concurrency_limit", self.gate.limit, service=self.service)
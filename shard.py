@@ -0,0 +1,222 @@
+"""
+Sharded sync runs.
+
+--shard i/N syncs only the devices whose serial hashes to shard i of N, so a fleet can be split
+across processes or hosts, each spending its own Snipe-IT API key's rate budget. Every shard
+still reads the whole Mosyle fleet; the hash decides which devices it writes. --shards N starts
+N shard processes on this host, waits for them and merges their summaries and metrics.
+
+Before starting the shards, --shards creates any Snipe-IT model the fleet is missing from the
+launcher, so shards meeting the same new model don't each create it. Shards started separately
+with --shard resolve models themselves and can still race; a model created twice that way shows
+up twice in Snipe-IT (the sync uses the lower id) and the extra one has to be deleted by hand.
+
+A [shard-i] section in settings.ini gives shard i its own Snipe-IT apiKey and rate_limit
+(and max_rate_limit, with adaptive limits).
+Shards without one share the [snipe-it] key and split its rate_limit evenly. Each shard keeps
+its own state store, so watermarks and checkpoints are tracked per shard.
+"""
+import argparse
+import copy
+import hashlib
+import json
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from logger_config import get_logger
+from metrics import Metrics, get_metrics
+
+
+def parse_shard(value):
+    """argparse type for --shard: "2/4" -> (2, 4)."""
+    try:
+        index, count = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected SHARD/COUNT, e.g. 1/4, not {value!r}")
+    if count < 1 or not 1 <= index <= count:
+        raise argparse.ArgumentTypeError(f"shard must be between 1 and {count}, not {index}")
+    return index, count
+
+
+def shard_of(serial, count):
+    """The shard (1 to count) a normalized serial belongs to; stable across runs, hosts and Python versions."""
+    digest = hashlib.blake2b(serial.encode("utf8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big") % count + 1
+
+
+def shard_config(config, index, count):
+    """
+    The configuration for shard `index` of `count`: its own Snipe-IT key, rate limit and state store.
+
+    Args:
+        config: Configuration dictionary from load_configuration()
+
+    Returns:
+        dict: A copy of config with the shard's settings applied
+    """
+    logger = get_logger()
+    config = copy.deepcopy(config)
+    overrides = config['shards'].get(index, {})
+    if overrides.get('apiKey'):
+        config['snipe']['apiKey'] = overrides['apiKey']
+        if overrides.get('rate_limit'):
+            config['snipe']['rate_limit'] = overrides['rate_limit']
+            # A [snipe-it] max_rate_limit was sized for the main key; default to the shard's own rate
+            config['snipe']['max_rate_limit'] = 0
+    else:
+        # Shards on one key share its throttle
+        config['snipe']['rate_limit'] = overrides.get('rate_limit') or max(1, config['snipe']['rate_limit'] // count)
+        config['snipe']['max_rate_limit'] //= count
+        logger.warning(
+            f"No apiKey in [shard-{index}], sharing the [snipe-it] key at {config['snipe']['rate_limit']} requests/minute"
+        )
+    if overrides.get('max_rate_limit'):
+        config['snipe']['max_rate_limit'] = overrides['max_rate_limit']
+    state_db = Path(config['cache']['state_db'])
+    config['cache']['state_db'] = str(state_db.with_name(f"{state_db.stem}.shard{index}of{count}{state_db.suffix}"))
+    return config
+
+
+def report_to_launcher(run, path):
+    """
+    Call run() in a shard started by launch_shards() and write its results to `path`, even if it fails.
+
+    Returns:
+        Whatever run() returned
+    """
+    started = time.monotonic()
+    processed = None
+    success = False
+    try:
+        processed = run()
+        success = True
+        return processed
+    finally:
+        with open(path, 'w') as f:
+            json.dump({
+                "processed": processed,
+                "success": success,
+                "seconds": time.monotonic() - started,
+                "metrics": get_metrics().snapshot()
+            }, f)
+
+
+def launch_shards(config, args, count, full_resync=False, calltype=None, resume=False):
+    """
+    Run one sync as `count` shard processes on this host and merge what they report.
+
+    Each shard logs to its own directory under --log-dir, shard-i, with its console output
+    in console.log there. The merged metrics go to the configured textfile.
+
+    Args:
+        config: Configuration dictionary from load_configuration()
+        args: Parsed command line; --config, --workers, --log-dir and --log-level are passed on,
+              and --record/--replay as a shard-N directory under the cassette directory
+        count: Number of shards
+
+    Returns:
+        int: Total number of devices processed
+
+    Raises:
+        RuntimeError: If any shard failed; the others' results are still merged and exported
+    """
+    logger = get_logger()
+    metrics = get_metrics()
+    # This run's shards, merged apart from earlier runs of a daemon
+    run_metrics = Metrics()
+    started = time.time()
+    logger.info(f"Starting {count} shard processes")
+
+    with tempfile.TemporaryDirectory(prefix="mosylesnipe-shards-") as work_dir:
+        shards = []
+        for index in range(1, count + 1):
+            log_dir = Path(args.log_dir) / f"shard-{index}"
+            log_dir.mkdir(parents=True, exist_ok=True)
+            summary = Path(work_dir) / f"shard-{index}.json"
+            command = [
+                sys.executable, str(Path(__file__).resolve().parent / "main.py"),
+                "--config", args.config,
+                "--shard", f"{index}/{count}",
+                "--workers", str(args.workers),
+                "--log-dir", str(log_dir),
+                "--log-level", args.log_level,
+                "--shard-summary", str(summary),
+            ]
+            if full_resync:
+                command.append("--full-resync")
+            if resume:
+                command.append("--resume")
+            if calltype:
+                command += ["--calltype", calltype]
+            # Each shard records or replays its own traffic next to the launcher's
+            if args.record:
+                command += ["--record", str(Path(args.record) / f"shard-{index}")]
+            if args.replay:
+                command += ["--replay", str(Path(args.replay) / f"shard-{index}"), "--replay-latency", str(args.replay_latency)]
+            console = open(log_dir / "console.log", "w")
+            shards.append((index, summary, subprocess.Popen(command, stdout=console, stderr=subprocess.STDOUT), console))
+
+        processed = 0
+        failed = []
+        for index, summary, process, console in shards:
+            returncode = process.wait()
+            console.close()
+            try:
+                with open(summary) as f:
+                    result = json.load(f)
+            except (OSError, ValueError):
+                result = None
+            if result is None:
+                logger.error(f"Shard {index}/{count} exited with status {returncode} without reporting, see {args.log_dir}/shard-{index}")
+                failed.append(index)
+                continue
+            run_metrics.merge(result['metrics'])
+            processed += result['processed'] or 0
+            if returncode != 0 or not result['success']:
+                failed.append(index)
+            logger.info(
+                f"Shard {index}/{count}: {result['processed'] or 0} devices processed in {result['seconds']:.1f}s"
+                + ("" if index not in failed else f", failed with status {returncode}")
+            )
+
+    # A shard that never reported still counts against the run
+    if failed:
+        run_metrics.set("last_run_success", 0)
+    metrics.merge(run_metrics.snapshot(), combine_gauges=False)
+    metrics.set("run_duration_seconds", time.time() - started)
+    metrics.set("last_run_timestamp_seconds", time.time())
+    if config['metrics']['textfile']:
+        try:
+            metrics.write_textfile(config['metrics']['textfile'])
+        except OSError as e:
+            logger.warning(f"Could not write metrics to {config['metrics']['textfile']}: {e}")
+
+    log_merged_summary(run_metrics)
+    if failed:
+        raise RuntimeError(f"Shards {', '.join(map(str, failed))} of {count} failed")
+    logger.info(f"=== Sharded run complete. Total devices processed: {processed} ===")
+    return processed
+
+
+def log_merged_summary(metrics):
+    """Log the run totals from the merged shard metrics."""
+    logger = get_logger()
+    by_type = {}
+    for labels, value in metrics.series("devices_total").items():
+        labels = dict(labels)
+        by_type.setdefault(labels['device_type'], {})[labels['outcome']] = int(value)
+    for deviceType, outcomes in sorted(by_type.items()):
+        logger.info(
+            f"{deviceType}: {outcomes.get('processed', 0)} processed, {outcomes.get('unchanged', 0)} unchanged, "
+            f"{outcomes.get('errors', 0)} failed"
+        )
+    updates = {dict(labels)['result']: int(value) for labels, value in metrics.series("asset_updates_total").items()}
+    tags = {dict(labels)['result']: int(value) for labels, value in metrics.series("asset_tags_total").items()}
+    logger.info(
+        f"Asset updates: {updates.get('skipped', 0)} skipped, {updates.get('partial', 0)} partial, "
+        f"{updates.get('full', 0)} full"
+    )
+    logger.info(f"Asset tags written to Mosyle: {tags.get('synced', 0)} synced, {tags.get('failed', 0)} failed")
@@ -1,14 +1,39 @@
 import mimetypes
 from unittest import result
+import html
 import requests
+import threading
 import time
-import base64
-from colorama import Fore
-from colorama import Style
+from contextlib import nullcontext
+
+from appledb import get_appledb
+from cache import read_json, write_json
+from ratelimit import AdaptiveController, TokenBucket
+from metrics import get_metrics
+from cassette import transport_adapter
+from logger_config import get_logger, LogPayload
+from imagecache import get_image_cache
+
+
+logger = get_logger()
+
+# Mosyle device attributes read by buildPayloadFromMosyle
+PAYLOAD_COLUMNS = (
+    "device_name",
+    "serial_number",
+    "bluetooth_mac_address",
+    "os",
+    "cpu_model",
+    "percent_disk",
+    "available_disk",
+    "osversion",
+    "wifi_mac_address",
+    "ethernet_mac_address",
+)
 
 
 class Snipe:
-    def __init__(self, snipetoken, url,manufacturer_id,macos_category_id,ios_category_id,tvos_category_id,rate_limit,macos_fieldset_id,ios_fieldset_id,tvos_fieldset_id,apple_image_check):
+    def __init__(self, snipetoken, url,manufacturer_id,macos_category_id,ios_category_id,tvos_category_id,rate_limit,macos_fieldset_id,ios_fieldset_id,tvos_fieldset_id,apple_image_check,appledb=None,image_cache=None,pool_size=10,timeout=(10, 60),adaptive=None):
         self.url = url
         self._snipetoken = snipetoken
         self.manufacturer_id = manufacturer_id
@@ -16,55 +41,309 @@ class Snipe:
         self.ios_category_id = ios_category_id
         self.tvos_category_id = tvos_category_id
         self.rate_limit = rate_limit
-        self.request_count = 0
+        self.rate_limiter = TokenBucket(rate_limit)
+        # With adaptive = {"max_rate": ..., "max_concurrency": ..., "latency_target": ...} the rate
+        # and requests in flight are tuned from the responses, within those ceilings
+        self.controller = AdaptiveController(self.rate_limiter, **adaptive) if adaptive else None
+        if self.controller is None:
+            get_metrics().set("rate_limit_per_minute", rate_limit, service="snipe")
         self.macos_fieldset_id = macos_fieldset_id
         self.ios_fieldset_id = ios_fieldset_id
         self.tvos_fieldset_id = tvos_fieldset_id
         self.apple_image_check = apple_image_check
+        self.appledb = appledb if appledb is not None else get_appledb()
+        self.image_cache = image_cache if image_cache is not None else get_image_cache()
+        # Hardware rows fetched once per run, keyed by normalized serial
+        self.hardware_index = {}
+        self.hardware_by_id = {}
+        # Model rows fetched once per run, keyed by normalized model_number and name
+        self.models_by_number = {}
+        self.models_by_name = {}
+        self.model_images_checked = set()
+        # Models Snipe-IT would not create this run, so later devices don't each try again
+        self.model_failures = set()
+        self._model_locks = {}
+        self._model_locks_guard = threading.Lock()
+        # User rows indexed by lowercased email and username. Until loadUserDirectory runs,
+        # every lookup falls back to a search, as the directory is not considered live.
+        self.users_by_email = {}
+        self.users_by_username = {}
+        self.user_directory_live = False
+        self.user_misses = set()
+        # One keep-alive connection pool shared by every worker; size it to the worker count
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = transport_adapter("snipe", url, pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        # content-type is left to requests, which sets it for json= bodies and multipart uploads alike
+        self.session.headers.update({
+            "authorization": "Bearer " + self._snipetoken,
+            "accept": "application/json",
+            "accept-encoding": "gzip, deflate",
+        })
 
     @property
     def headers(self):
-        return {
-            "authorization": "Bearer " + self._snipetoken,
-            "accept": "application/json",
-            "content-type": "application/json",
-        }    
+        return self.session.headers
 
     #@property
     def listHardware(self, serial):
-        print('Requesting Snipe Harware list at url '+ self.url + "/hardware/byserial/")
+        logger.debug("Requesting Snipe hardware by serial %s", serial)
         return self.snipeItRequest("GET", "/hardware/byserial/" + serial)
 
+    @staticmethod
+    def normalizeSerial(serial):
+        return str(serial).strip().upper()
+
+    def listAllRows(self, endpoint, page_size=500, params=None):
+        """
+        Page through a Snipe-IT list endpoint and return every row.
+
+        :param endpoint: List endpoint, e.g. "/hardware" or "/models"
+        :param page_size: Rows requested per page (Snipe-IT caps this at its API_MAX_RECORDS)
+        :param params: Extra query filters, e.g. {"manufacturer_id": 1}
+        :raises Exception: If a page fails, isn't a listing, or paging ends short of the total;
+                           a partial list would make the missing rows look absent from Snipe-IT
+        """
+        rows = []
+        offset = 0
+        while True:
+            query = {"limit": page_size, "offset": offset, "sort": "id", "order": "asc"}
+            if params:
+                query.update(params)
+            response = self.snipeItRequest("GET", endpoint, params=query)
+            if response is None:
+                raise Exception(f"Failed to list {endpoint} at offset {offset}")
+            try:
+                data = response.json()
+            except ValueError:
+                data = None
+            if not response.ok or not isinstance(data, dict) or data.get('status') == 'error':
+                messages = data.get('messages') if isinstance(data, dict) else None
+                raise Exception(f"Failed to list {endpoint} at offset {offset}: {messages or f'HTTP {response.status_code}'}")
+            page, total = data.get('rows'), data.get('total')
+            if not isinstance(page, list) or not isinstance(total, int):
+                raise Exception(f"Failed to list {endpoint} at offset {offset}: response has no rows and total")
+            rows.extend(page)
+            offset += len(page)
+            if offset >= total:
+                break
+            if not page:
+                raise Exception(f"Listing {endpoint} stopped at {offset} of {total} rows")
+        return rows
+
+    def listAllHardware(self, page_size=500, params=None):
+        return self.listAllRows("/hardware", page_size, params)
+
+    def loadHardwareIndex(self, page_size=500):
+        """
+        Fetch all Apple hardware once and index it by normalized serial.
+
+        Archived assets are hidden from /hardware by default, so they are fetched in a second
+        pass; otherwise an archived device would look missing and be created again.
+        """
+        logger.info("Loading Snipe hardware index for manufacturer %s", self.manufacturer_id)
+        self.hardware_index = {}
+        self.hardware_by_id = {}
+        for status in (None, "Archived"):
+            params = {"manufacturer_id": self.manufacturer_id}
+            if status:
+                params["status"] = status
+            for row in self.listAllHardware(page_size, params):
+                self._indexAsset(row)
+        logger.info("Indexed %d hardware assets", len(self.hardware_index))
+        return self.hardware_index
+
+    def findHardware(self, serial):
+        """Return the indexed hardware row for a serial, or None if Snipe-IT has no such asset."""
+        return self.hardware_index.get(self.normalizeSerial(serial))
+
+    def _indexAsset(self, row):
+        if row.get('serial'):
+            self.hardware_index[self.normalizeSerial(row['serial'])] = row
+        if row.get('id') is not None:
+            self.hardware_by_id[row['id']] = row
+
+    def _mergeAssetPayload(self, row, payload):
+        """Apply a successful create/update payload to an indexed row so it mirrors Snipe-IT."""
+        custom_fields = row.setdefault('custom_fields', {})
+        by_field = {field.get('field'): field for field in custom_fields.values() if isinstance(field, dict)}
+        for key, value in payload.items():
+            if key == 'model_id':
+                row['model'] = {**(row.get('model') or {}), "id": value}
+            elif key.startswith('_snipeit_'):
+                if key in by_field:
+                    by_field[key]['value'] = value
+                else:
+                    custom_fields[key] = {"field": key, "value": value}
+            else:
+                row[key] = value
+        return row
+
+    @staticmethod
+    def normalizeModel(model):
+        return str(model).strip().lower()
+
+    def loadModelCatalog(self, page_size=500):
+        """
+        Fetch every model once and index it for exact model_number/name lookups.
+
+        Raises if the listing fails rather than leaving an empty catalog, which would have
+        getModelId create every model again.
+        """
+        logger.info("Loading Snipe model catalog")
+        rows = self.listAllRows("/models", page_size)
+        self.models_by_number = {}
+        self.models_by_name = {}
+        self.model_images_checked = set()
+        self.model_failures = set()
+        for row in rows:
+            self._indexModel(row)
+        logger.info("Indexed %d model numbers and %d model names", len(self.models_by_number), len(self.models_by_name))
+        return self.models_by_number
+
+    def _indexModel(self, row):
+        # Duplicates of a model resolve to its lowest id, so every shard and run settles on the same one
+        for index, field in ((self.models_by_number, 'model_number'), (self.models_by_name, 'name')):
+            if not row.get(field):
+                continue
+            key = self.normalizeModel(row[field])
+            existing = index.get(key)
+            if existing is None or existing['id'] is None or (row['id'] is not None and row['id'] <= existing['id']):
+                index[key] = row
+
+    def findModel(self, model):
+        """Return the catalog row whose model_number (or failing that, name) is exactly `model`."""
+        key = self.normalizeModel(model)
+        return self.models_by_number.get(key) or self.models_by_name.get(key)
+
+    def getModelId(self, model, os):
+        """
+        Resolve a Mosyle device model to a Snipe-IT model id, creating the model if needed.
+
+        Existing models without an image get one AppleDB lookup per run at most.
+
+        :param model: Mosyle device_model, e.g. "MacBookPro18,3"
+        :param os: Mosyle os type (mac, ios or tvos), used to pick the category and fieldset
+        :return: Model id, or None if the model could not be resolved or created; a failed model is not retried this run
+        """
+        # Workers resolving the same new model must not each create it
+        with self._modelLock(model):
+            return self._resolveModelId(model, os)
+
+    def _modelLock(self, model):
+        with self._model_locks_guard:
+            return self._model_locks.setdefault(self.normalizeModel(model), threading.Lock())
+
+    def _resolveModelId(self, model, os):
+        if self.normalizeModel(model) in self.model_failures:
+            return None
+        row = self.findModel(model)
+        if row is None:
+            # Another shard or sync may have created the model since the catalog was loaded
+            row = self.lookupModel(model)
+        if row is not None:
+            self._ensureModelImage(row, model)
+            return row['id']
+
+        logger.info("Model %s not in catalog, creating it", model)
+        if os == "mac":
+            response = self.createModel(model)
+        elif os == "ios":
+            response = self.createMobileModel(model)
+        elif os == "tvos":
+            response = self.createAppleTvModel(model)
+        else:
+            logger.warning("Unknown os type %s for model %s", os, model)
+            self.model_failures.add(self.normalizeModel(model))
+            return None
+
+        # Shards racing to create the model may have made duplicates, or had theirs refused as one;
+        # either way, pick up whatever Snipe-IT now holds
+        row = self.lookupModel(model)
+        if row is None:
+            logger.error("Failed to create model %s: %s", model, LogPayload(response.text if response is not None else 'no response'))
+            self.model_failures.add(self.normalizeModel(model))
+            return None
+        return row['id']
+
+    def _ensureModelImage(self, row, model):
+        if row.get('image') is not None or row['id'] in self.model_images_checked:
+            return
+        self.model_images_checked.add(row['id'])
+        if not self.apple_image_check:
+            return
+
+        logger.debug("Model %s has no picture, setting one", model)
+        image_data_url = self.getImageForModel(model)
+        if not image_data_url:
+            logger.debug("No image found for model %s", model)
+            return
+        response = self.updateModel(str(row['id']), {"image": image_data_url})
+        if response is not None and response.ok and response.json().get('status') == 'success':
+            row['image'] = (response.json().get('payload') or {}).get('image') or image_data_url
+
+    def _indexCreatedModel(self, response, payload):
+        if response is None or not response.ok:
+            return
+        result = response.json()
+        if result.get('status') != 'success':
+            return
+        created = result.get('payload') or {}
+        row = {
+            "id": created.get('id'),
+            "name": created.get('name', payload['name']),
+            "model_number": created.get('model_number', payload['model_number']),
+            "image": created.get('image', payload.get('image'))
+        }
+        self._indexModel(row)
+        # Freshly created models already carry whatever image AppleDB had
+        self.model_images_checked.add(row['id'])
+
+    def lookupModel(self, model):
+        """
+        Search Snipe-IT for a model missing from the catalog and index any exact matches.
+
+        :return: Catalog row for the model (the lowest id if there are duplicates), or None
+        """
+        key = self.normalizeModel(model)
+        response = self.snipeItRequest("GET", "/models", params={
+            "limit": "50", "offset": "0", "search": model, "sort": "id", "order": "asc"
+        })
+        if response is None or not response.ok:
+            return self.findModel(model)
+        matches = [
+            row for row in response.json().get('rows', [])
+            if key in (self.normalizeModel(row.get('model_number') or ''), self.normalizeModel(row.get('name') or ''))
+        ]
+        if len(matches) > 1:
+            logger.warning("Snipe-IT holds %d models for %s, using id %s", len(matches), model, min(row['id'] for row in matches))
+        for row in matches:
+            self._indexModel(row)
+        return self.findModel(model)
+
     def listAllModels(self):
-        print('requesting all apple models')
+        logger.debug("Requesting all Apple models")
         return self.snipeItRequest("GET","/models", params = {"limit": "200", "offset": "0", "sort": "created_at", "order": "asc"})
 
     def searchModel(self, model):
-        print('Requesting Snipe Model list')
+        logger.debug("Searching Snipe models for %s", model)
         result = self.snipeItRequest("GET", "/models", params={
             "limit": "50", "offset": "0", "search": model, "sort": "created_at", "order": "asc"
         })
         jsonResult = result.json()
 
         if jsonResult['total'] == 0:
-            print("Model was not found.")
+            logger.debug("Model %s was not found", model)
         else:
-            print("Model was found.")
+            logger.debug("Model %s was found", model)
             model_data = jsonResult['rows'][0]
 
             if model_data['image'] is None:
-                print("The model does not have a picture. Let's set one.")
-                image_data_url = self.getImageForModel(model)
-
-                if not image_data_url:
-                    print("Failed to get image.")
-                else:
-                    payload = {
-                        "image": image_data_url
-                    }
-                    self.updateModel(str(model_data['id']), payload)
+                self._ensureModelImage(model_data, model)
             else:
-                print("Image already set.")
+                logger.debug("Model %s already has an image", model)
 
         return result
 
@@ -83,65 +362,187 @@ class Snipe:
             "image":imageResponse
         }
 
-        print('Creating Snipe Model with payload:', payload)
+        logger.debug("Creating Snipe model with payload %s", LogPayload(payload))
         results = self.snipeItRequest("POST", "/models", json = payload)
         #print('the server returned ', results);
+        self._indexCreatedModel(results, payload)
         return results
 
     def createAsset(self, model, payload):
-        print('Creating Snipe Hardware')
-        print(payload);
+        logger.debug("Creating Snipe hardware with payload %s", LogPayload(payload))
         payload['status_id'] = 2
         payload['model_id'] = model
         payload['asset_tag'] = payload['serial']
         
-        #print(asset)
-        return self.snipeItRequest("POST", "/hardware", json = payload).json()
+        response = self.snipeItRequest("POST", "/hardware", json = payload)
+        if response is None:
+            return {"status": "error", "messages": "No response from Snipe-IT"}
+        result = response.json()
+        if result.get('status') == 'success':
+            created = result.get('payload') or {}
+            row = self._mergeAssetPayload({"id": created.get('id'), "assigned_to": None}, payload)
+            row['asset_tag'] = created.get('asset_tag', payload['asset_tag'])
+            self._indexAsset(row)
+        return result
 
     def assignAsset(self, user, asset_id):
-        print('Assigning asset '+str(asset_id)+' to user '+user)
-        email_to_match = user.lower()
-
-        payload = {
-            "search": email_to_match,
-            "limit": 10  # Increase in case multiple matches exist
-        }
-        response = self.snipeItRequest("GET", "/users", params=payload).json()
-        print(f"{response} Payload: {payload}")
-        if response['total'] == 0:
-            return
-
-        # Find exact email match
-        user_row = next((row for row in response['rows'] if row['email'].lower() == email_to_match), None)
+        logger.debug("Assigning asset %s to user %s", asset_id, user)
+        user_row = self.findUser(user)
 
         if not user_row:
-            print(f"No exact match found for {email_to_match}")
+            logger.warning("No Snipe-IT user matches %s, not assigning asset %s", user.lower(), asset_id)
             return
 
         payload = {
             "assigned_user": user_row['id'],
             "checkout_to_type": "user"
         }
-        return self.snipeItRequest("POST", f"/hardware/{asset_id}/checkout", json=payload)
+        response = self.snipeItRequest("POST", f"/hardware/{asset_id}/checkout", json=payload)
+        if response is not None and response.ok and asset_id in self.hardware_by_id:
+            self.hardware_by_id[asset_id]['assigned_to'] = {
+                "id": user_row['id'],
+                "username": user_row.get('username'),
+                "email": user_row.get('email'),
+                "type": "user"
+            }
+        return response
+
+
+    def loadUserDirectory(self, page_size=500, cache_path=None, ttl=0):
+        """
+        Fetch every user once and index them by lowercased email and username.
+
+        :param page_size: Rows requested per page
+        :param cache_path: Optional JSON file holding the directory between runs
+        :param ttl: Seconds the on-disk copy stays usable; 0 always fetches from Snipe-IT
+
+        If the directory can't be fetched, users are looked up one search at a time instead,
+        starting from the on-disk copy if there is one, however old.
+        """
+        cached = read_json(cache_path) if cache_path and ttl > 0 else None
+        self.user_directory_live = False
+        if cached and time.time() - cached.get('fetched_at', 0) < ttl:
+            logger.info("Using cached user directory from %s", cache_path)
+            rows = cached['rows']
+        else:
+            logger.info("Loading Snipe user directory")
+            try:
+                rows = [
+                    {"id": row['id'], "username": row.get('username'), "email": row.get('email')}
+                    for row in self.listAllRows("/users", page_size)
+                ]
+            except Exception as e:
+                logger.warning("Could not load the Snipe user directory, searching for users one at a time: %s", e)
+                rows = cached['rows'] if cached else []
+            else:
+                self.user_directory_live = True
+                if cache_path and ttl > 0:
+                    write_json(cache_path, {"fetched_at": time.time(), "rows": rows})
+
+        self.users_by_email = {}
+        self.users_by_username = {}
+        self.user_misses = set()
+        for row in rows:
+            self._indexUser(row)
+        logger.info("Indexed %d users", len(rows))
+        return self.users_by_email
+
+    def _indexUser(self, row):
+        if row.get('email'):
+            self.users_by_email.setdefault(row['email'].lower(), row)
+        if row.get('username'):
+            self.users_by_username.setdefault(row['username'].lower(), row)
+
+    def findUser(self, user):
+        """
+        Resolve a Mosyle user email to a Snipe-IT user row by exact email, then username.
 
+        A directory read from the on-disk copy may predate new accounts, and one that failed to
+        load is empty, so a miss there falls back to one search request per user per run.
+        """
+        key = user.lower()
+        row = self.users_by_email.get(key) or self.users_by_username.get(key)
+        if row is not None or self.user_directory_live or key in self.user_misses:
+            return row
+
+        payload = {
+            "search": key,
+            "limit": 10  # Increase in case multiple matches exist
+        }
+        response = self.snipeItRequest("GET", "/users", params=payload)
+        if response is None or not response.ok:
+            # Not a confirmed miss; a later device for this user searches again
+            logger.warning("Could not search Snipe-IT for user %s", key)
+            return None
+        for candidate in response.json().get('rows', []):
+            self._indexUser({"id": candidate['id'], "username": candidate.get('username'), "email": candidate.get('email')})
+        row = self.users_by_email.get(key) or self.users_by_username.get(key)
+        if row is None:
+            self.user_misses.add(key)
+        return row
 
     def unasigneAsset(self, asset_id):
-        print('Unassigning asset '+str(asset_id))
-        return self.snipeItRequest("POST", "/hardware/" + str(asset_id) + "/checkin")
+        logger.debug("Unassigning asset %s", asset_id)
+        response = self.snipeItRequest("POST", "/hardware/" + str(asset_id) + "/checkin")
+        if response is not None and response.ok and asset_id in self.hardware_by_id:
+            self.hardware_by_id[asset_id]['assigned_to'] = None
+        return response
 
     def updateAsset(self, asset_id, payload, model_id=None):
-        print('Updating asset ' + str(asset_id))
+        logger.debug("Updating asset %s", asset_id)
         payload = dict(payload)  # Make a copy to avoid mutating the original
         payload.pop('serial', None)
 
         if model_id:
             payload['model_id'] = model_id  # Include model assignment
 
-        return self.snipeItRequest("PATCH", "/hardware/" + str(asset_id), json=payload)
+        response = self.snipeItRequest("PATCH", "/hardware/" + str(asset_id), json=payload)
+        if response is not None and response.ok and response.json().get('status') == 'success':
+            row = self.hardware_by_id.get(asset_id)
+            if row is not None:
+                self._mergeAssetPayload(row, payload)
+        return response
+
 
+    @staticmethod
+    def _comparable(value):
+        # Snipe-IT HTML-escapes strings in API rows; treat None and "" alike
+        if value is None:
+            return ""
+        return html.unescape(str(value)).strip()
+
+    def diffAssetPayload(self, row, payload, model_id=None):
+        """
+        Compare a payload from buildPayloadFromMosyle against an asset row already fetched from Snipe-IT.
+
+        :param row: Hardware row from the index
+        :param payload: Desired field values, custom fields keyed by their _snipeit_ db column
+        :param model_id: Desired model id
+        :return: Dict holding only the fields whose value differs
+        """
+        custom_values = {
+            field.get('field'): field.get('value')
+            for field in (row.get('custom_fields') or {}).values() if isinstance(field, dict)
+        }
+        wanted = dict(payload)
+        wanted.pop('serial', None)
+        if model_id:
+            wanted['model_id'] = model_id
+
+        changes = {}
+        for key, value in wanted.items():
+            if key == 'model_id':
+                current = (row.get('model') or {}).get('id')
+            elif key.startswith('_snipeit_'):
+                current = custom_values.get(key)
+            else:
+                current = row.get(key)
+            if self._comparable(current) != self._comparable(value):
+                changes[key] = value
+        return changes
 
     def createMobileModel(self, model):
-        print('creating new mobile Model')
+        logger.debug("Creating new mobile model %s", model)
         imageResponse = self.getImageForModel(model);
         if(imageResponse == False):
             imageResponse = None
@@ -153,9 +554,11 @@ class Snipe:
             "fieldset_id": self.ios_fieldset_id,
             "image": imageResponse
         }
-        return self.snipeItRequest("POST", "/models", json = payload)
+        results = self.snipeItRequest("POST", "/models", json = payload)
+        self._indexCreatedModel(results, payload)
+        return results
     def createAppleTvModel(self, model):
-        print('creating new Apple Tv Model')
+        logger.debug("Creating new Apple TV model %s", model)
         imageResponse = self.getImageForModel(model);
         if(imageResponse == False):
             imageResponse = None
@@ -167,13 +570,16 @@ class Snipe:
             "fieldset_id": self.tvos_fieldset_id,
             "image": imageResponse
         }
-        return self.snipeItRequest("POST", "/models", json = payload)
+        results = self.snipeItRequest("POST", "/models", json = payload)
+        self._indexCreatedModel(results, payload)
+        return results
 
     def updateModel(self, model_id, payload):
-        print("updating model "+model_id+" with payload", payload)
+        logger.debug("Updating model %s with payload %s", model_id, LogPayload(payload))
         return self.snipeItRequest("PATCH", "/models/"+model_id, json = payload)
 
     def buildPayloadFromMosyle(self, payload):
+        # Keep PAYLOAD_COLUMNS in step with the Mosyle attributes read here
         finalPayload = {
             #"asset_tag": asset,
             "name": payload['device_name'],
@@ -219,113 +625,131 @@ class Snipe:
     def snipeItRequest(self, type, url, params=None, json=None):
         max_retries = 5
         retry_delay = 60  # seconds
+        metrics = get_metrics()
 
         for attempt in range(max_retries):
-            if self.request_count >= self.rate_limit:
-                print(Fore.YELLOW + "Max requests per minute reached. Sleeping for 60 seconds..." + Style.RESET_ALL)
-                time.sleep(60)
-                self.request_count = 0
-
+            waited = self.rate_limiter.acquire()
+            if waited:
+                metrics.inc("rate_limiter_sleep_seconds_total", waited, service="snipe")
+            if waited >= 1:
+                logger.info("Rate limit budget spent, waited %.1f seconds", waited)
+            if waited and self.controller is not None:
+                self.controller.throttled()
+
+            started = time.monotonic()
             try:
-                self.request_count += 1
-                print(f'Sending {type} request to Snipe-IT: {url}')
-
-                if type == "GET":
-                    response = requests.get(self.url + url, headers=self.headers, params=params)
-                elif type == "POST":
-                    response = requests.post(self.url + url, headers=self.headers, json=json)
-                elif type == "PATCH":
-                    response = requests.patch(self.url + url, headers=self.headers, json=json)
-                elif type == "DELETE":
-                    response = requests.delete(self.url + url, headers=self.headers)
-                else:
-                    print(Fore.RED + 'Unknown request type' + Style.RESET_ALL)
+                logger.debug("Sending %s request to Snipe-IT: %s", type, url)
+
+                if type not in ("GET", "POST", "PATCH", "DELETE"):
+                    logger.error("Unknown request type %s", type)
                     return None
+                with self._requestSlot():
+                    # Time the request itself, not the wait for a slot
+                    started = time.monotonic()
+                    response = self._send(type, url, params=params, json=json)
+                elapsed = time.monotonic() - started
+                metrics.observe_request("snipe", type, url, elapsed, response.status_code)
+                if self.controller is not None:
+                    self.controller.observe(elapsed, response.status_code)
+
+                self.rate_limiter.update_from_headers(response.headers, response.status_code)
 
                 if response.status_code == 429:
-                    print(Fore.YELLOW + f"Rate limited by server (429). Waiting {retry_delay} seconds before retrying..." + Style.RESET_ALL)
-                    time.sleep(retry_delay)
+                    # The limiter holds every thread back until Retry-After has passed
+                    metrics.inc("retries_total", service="snipe", reason="rate_limited")
+                    logger.warning("Rate limited by server (429) on %s %s, retrying once the limiter allows it", type, url)
                     continue
 
                 if response.status_code >= 500:
-                    print(Fore.RED + f"Server error {response.status_code}. Retrying in {retry_delay} seconds..." + Style.RESET_ALL)
+                    metrics.inc("retries_total", service="snipe", reason="server_error")
+                    logger.warning("Server error %d on %s %s, retrying in %d seconds", response.status_code, type, url, retry_delay)
                     time.sleep(retry_delay)
-                    self.request_count = 0
                     continue
 
                 return response
 
             except requests.RequestException as e:
-                print(Fore.RED + f"Request failed: {e}. Retrying in {retry_delay} seconds..." + Style.RESET_ALL)
+                metrics.observe_request("snipe", type, url, time.monotonic() - started, "error")
+                if self.controller is not None:
+                    self.controller.observe(time.monotonic() - started, "error")
+                metrics.inc("retries_total", service="snipe", reason="connection_error")
+                logger.warning("Request %s %s failed: %s, retrying in %d seconds", type, url, e, retry_delay)
                 time.sleep(retry_delay)
 
-        print(Fore.RED + f"Failed to complete request after {max_retries} attempts: {url}" + Style.RESET_ALL)
+        metrics.inc("request_failures_total", service="snipe")
+        logger.error("Failed to complete request after %d attempts: %s %s", max_retries, type, url)
         return None
 
 
-    def getImageForModel(self, model_number):
+    def getModelImage(self, model_number, size=256):
+        """
+        Look up the AppleDB image for a model, served from the local image cache when possible.
+
+        :param model_number: Model identifier, e.g. "MacBookPro18,3"
+        :param size: Image width to request from img.appledb.dev
+        :return: ModelImage, or None if image checking is disabled or no image exists
+        """
         if not self.apple_image_check:
-            print("Image checking is disabled.")
-            return False
+            logger.debug("Image checking is disabled")
+            return None
 
-        print(f"Trying to look up model info from AppleDB: {model_number}")
+        logger.debug("Looking up model info from AppleDB: %s", model_number)
         try:
-            response = requests.get("https://api.appledb.dev/device/main.json")
-            response.raise_for_status()
-            devices = response.json()
-
-            for device in devices:
-                identifiers = device.get("identifier", [])
-                device_maps = device.get("deviceMap", [])
-
-                if model_number in device_maps or model_number in identifiers:
-                    device_key = device.get("key", model_number)
-                    colors = device.get("colors", [])
-                    color = colors[0]["key"] if colors and isinstance(colors[0], dict) and "key" in colors[0] else "Silver"
-
-                    image_url = f"https://img.appledb.dev/device@256/{device_key}/{color}.png"
-                    print(f"Found match. Trying image URL: {image_url}")
+            match = self.appledb.lookup(model_number)
+            if match is None:
+                logger.info("No matching identifier or deviceMap found in AppleDB for %s", model_number)
+                return None
 
-                    img_response = requests.get(image_url)
-                    img_response.raise_for_status()
-
-                    base64encoded = base64.b64encode(img_response.content).decode("utf8")
-                    full_image_string = "data:image/png;name=image.png;base64," + base64encoded
-                    return full_image_string
-
-            print(f"No matching identifier or deviceMap found for {model_number}")
+            device_key, color = match
+            logger.debug("Found AppleDB match, using image for %s (%s)", device_key, color)
+            return self.image_cache.get(device_key, color, size)
 
         except requests.exceptions.RequestException as e:
-            print(Fore.RED + f"Error getting image from AppleDB: {e}" + Style.RESET_ALL)
+            logger.warning("Error getting image from AppleDB: %s", e)
         except Exception as e:
-            print(Fore.RED + f"Unexpected error during AppleDB lookup: {e}" + Style.RESET_ALL)
+            logger.error("Unexpected error during AppleDB lookup: %s", e)
 
-        return False
+        return None
 
+    def _requestSlot(self):
+        return self.controller.slot() if self.controller is not None else nullcontext()
 
+    def _send(self, type, url, params=None, json=None, files=None):
+        """Send one request to Snipe-IT over the pooled session."""
+        return self.session.request(type, self.url + url, params=params, json=json, files=files, timeout=self.timeout)
 
-    def setImageForModel(self, model_id, image_bytes):
+    def getImageForModel(self, model_number):
+        image = self.getModelImage(model_number)
+        if image is None:
+            return False
+        return image.data_url
+
+    def setImageForModel(self, model_id, image_bytes=None, model_number=None):
         """
         Uploads an image to a model in Snipe-IT.
 
         :param model_id: ID of the model in Snipe-IT
         :param image_bytes: Raw image bytes (from requests.get().content)
+        :param model_number: If image_bytes is not given, upload the cached AppleDB image for this model
         """
-        url = f"{self.url}/models/{model_id}"
-        headers = {
-            "Authorization": f"Bearer {self._snipetoken}"
-        }
-        files = {
-            "image": ("image.png", image_bytes, "image/png")
-        }
+        if image_bytes is not None:
+            files = {
+                "image": ("image.png", image_bytes, "image/png")
+            }
+        else:
+            image = self.getModelImage(model_number)
+            if image is None:
+                logger.info("No image available for model %s", model_number)
+                return None
+            files = image.multipart
 
         try:
-            response = requests.post(url, headers=headers, files=files)
+            response = self._send("POST", f"/models/{model_id}", files=files)
             response.raise_for_status()
-            print(Fore.GREEN + f"Successfully uploaded image for model ID {model_id}" + Style.RESET_ALL)
+            logger.info("Uploaded image for model ID %s", model_id)
             return response
         except requests.RequestException as e:
-            print(Fore.RED + f"Failed to upload image to model {model_id}: {e}" + Style.RESET_ALL)
+            logger.error("Failed to upload image to model %s: %s", model_id, e)
             return None
 
 
@@ -0,0 +1,141 @@
+"""
+Persistent sync state for incremental runs.
+Records, per serial, what was last synced to Snipe-IT so unchanged devices can be skipped.
+"""
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from logger_config import get_logger
+
+
+SCHEMA_VERSION = 1
+
+# Devices recorded between commits; a crash loses at most this many records, which only
+# means those devices are compared against Snipe-IT again next run
+COMMIT_EVERY = 100
+
+
+def fingerprint(device):
+    """Stable hash of a Mosyle device record; DeviceRecords supply their own."""
+    if hasattr(device, "fingerprint"):
+        return device.fingerprint()
+    encoded = json.dumps(device, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(encoded.encode("utf8")).hexdigest()
+
+
+class SyncState:
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._pending = 0
+        self.conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self._migrate()
+
+    def _migrate(self):
+        logger = get_logger()
+        with self._lock, self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            row = self.conn.execute("SELECT value FROM meta WHERE key = 'schema_version'").fetchone()
+            version = int(row['value']) if row else None
+            if version != SCHEMA_VERSION:
+                if version is not None:
+                    # The store only caches what Snipe-IT already holds, so rebuilding it is safe
+                    logger.warning(f"Sync state schema {version} does not match {SCHEMA_VERSION}, rebuilding {self.path}")
+                self.conn.execute("DROP TABLE IF EXISTS devices")
+                self.conn.execute("""
+                    CREATE TABLE devices (
+                        serial TEXT PRIMARY KEY,
+                        asset_id INTEGER,
+                        payload_hash TEXT,
+                        assigned_user TEXT,
+                        asset_tag TEXT,
+                        synced_at REAL
+                    )
+                """)
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO meta (key, value) VALUES ('schema_version', ?)", (str(SCHEMA_VERSION),)
+                )
+            # Added alongside the devices table; older stores just gain it, keeping their records
+            self.conn.execute("CREATE TABLE IF NOT EXISTS pending_tags (serial TEXT PRIMARY KEY, asset_tag TEXT)")
+
+    def get(self, serial):
+        """Return the last synced record for a serial as a dict, or None."""
+        with self._lock:
+            row = self.conn.execute("SELECT * FROM devices WHERE serial = ?", (serial,)).fetchone()
+        return dict(row) if row else None
+
+    def record(self, serial, asset_id, payload_hash, assigned_user, asset_tag):
+        """Store the outcome of a successful device sync."""
+        with self._lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO devices (serial, asset_id, payload_hash, assigned_user, asset_tag, synced_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (serial, asset_id, payload_hash, assigned_user, asset_tag, time.time())
+            )
+            self._pending += 1
+            if self._pending >= COMMIT_EVERY:
+                self.conn.commit()
+                self._pending = 0
+
+    def get_meta(self, key, default=None):
+        with self._lock:
+            row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row['value'] if row else default
+
+    def set_meta(self, key, value):
+        with self._lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(value)))
+
+    def save_checkpoint(self, checkpoint, pending_tags):
+        """
+        Durably record the progress of a run, with the asset tags it has yet to write back.
+
+        Device records written so far are committed in the same transaction, so the
+        checkpoint never claims devices the store doesn't hold.
+
+        Args:
+            checkpoint: JSON-serialisable progress of the run (see run_sync)
+            pending_tags: Dict of serial -> asset tag not yet confirmed by Mosyle
+        """
+        with self._lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('checkpoint', ?)",
+                (json.dumps(checkpoint, sort_keys=True),)
+            )
+            self.conn.execute("DELETE FROM pending_tags")
+            self.conn.executemany(
+                "INSERT INTO pending_tags (serial, asset_tag) VALUES (?, ?)", pending_tags.items()
+            )
+            self._pending = 0
+
+    def load_checkpoint(self):
+        """Return (checkpoint, pending tags) saved by an interrupted run, or (None, {})."""
+        with self._lock:
+            row = self.conn.execute("SELECT value FROM meta WHERE key = 'checkpoint'").fetchone()
+            if row is None:
+                return None, {}
+            tags = self.conn.execute("SELECT serial, asset_tag FROM pending_tags").fetchall()
+        return json.loads(row['value']), {tag['serial']: tag['asset_tag'] for tag in tags}
+
+    def clear_checkpoint(self):
+        with self._lock, self.conn:
+            self.conn.execute("DELETE FROM meta WHERE key = 'checkpoint'")
+            self.conn.execute("DELETE FROM pending_tags")
+            self._pending = 0
+
+    def commit(self):
+        with self._lock:
+            self.conn.commit()
+            self._pending = 0
+
+    def close(self):
+        self.commit()
+        self.conn.close()